@@ -1,28 +1,108 @@
 import click
+import importlib
+from datetime import datetime
+from functools import partial
 from pathlib import Path
+from songtools import config
 from songtools.backlog import (
     clean_preimport_folder,
     delete_song_folder,
     load_backlog_folder_files,
     load_backlog_folder_metadata,
     dedup_song_folder,
+    dedup_song_folder_by_content,
+    rehash_backlog_songs,
 )
 
+from songtools.cleaning_plan import (
+    apply_cleaning_plan,
+    CleaningPlan,
+    plan_cleaning,
+)
 from songtools.song_collection import (
     show_collection_name_inconsistencies,
     sync_collection_items,
 )
-from songtools.db.session import get_engine
+from songtools.db.session import dispose_engine, get_engine
+from songtools.folder_jobs import (
+    clean_folder_job,
+    echo_job_summary,
+    load_folder_files_job,
+    run_folder_jobs,
+)
+from songtools.metrics import MetricsReport, set_command
+from songtools.profiling import Profiler
+
+
+class LazyGroup(click.Group):
+    """Group whose commands are imported only when they are used.
+    Keeps heavy dev tooling out of the start of every command.
+    """
+
+    def __init__(self, *args, lazy_commands: dict[str, str], **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted([*super().list_commands(ctx), *self.lazy_commands])
+
+    def get_command(self, ctx: click.Context, name: str) -> click.Command | None:
+        if name in self.lazy_commands:
+            module, attribute = self.lazy_commands[name].split(":")
+            return getattr(importlib.import_module(module), attribute)
+        return super().get_command(ctx, name)
 
 
 @click.group()
-def app() -> None:
-    pass
+@click.option(
+    "--profile",
+    default=False,
+    is_flag=True,
+    help="Profile the command and print the time spent in its stages",
+)
+@click.option(
+    "--profile-out",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Where to store the cProfile stats, defaults to the log directory",
+)
+@click.option(
+    "--metrics-out",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Store run metrics, as a Prometheus textfile for .prom paths, else JSON",
+)
+@click.option(
+    "--quiet",
+    default=False,
+    is_flag=True,
+    help="Don't print INFO and OK messages",
+)
+@click.pass_context
+def app(
+    ctx: click.Context,
+    profile: bool,
+    profile_out: str | None,
+    metrics_out: str | None,
+    quiet: bool,
+) -> None:
+    if quiet:
+        config.log_quiet = True
+    # One engine is shared by the whole run
+    ctx.call_on_close(dispose_engine)
+    if metrics_out:
+        ctx.with_resource(MetricsReport(Path(metrics_out)))
+    if profile:
+        if profile_out is None:
+            timestamp = int(datetime.now().timestamp())
+            profile_out = Path(config.log_dir) / f"songtools-{timestamp}.prof"
+        ctx.with_resource(Profiler(Path(profile_out)))
 
 
 @app.group()
-def backlog() -> None:
-    pass
+@click.pass_context
+def backlog(ctx: click.Context) -> None:
+    set_command(f"{ctx.info_name} {ctx.invoked_subcommand}")
 
 
 @backlog.command()
@@ -38,11 +118,59 @@ def load_songs() -> None:
     default=None,
     help="Select which subfolders to clean",
 )
-def clean_folder(folder_path: str, path_select: str) -> None:
-    click.echo("Cleaning songs")
+@click.option(
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of subfolders cleaned at once, each in its own process",
+)
+@click.option(
+    "--plan-out",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Only plan the cleaning and store the plan, --jobs processes read files",
+)
+@click.option(
+    "--apply-plan",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Apply a plan stored with --plan-out",
+)
+def clean_folder(
+    folder_path: str,
+    path_select: str,
+    jobs: int,
+    plan_out: str | None,
+    apply_plan: str | None,
+) -> None:
     base_folder = Path(folder_path)
+    if plan_out and apply_plan:
+        raise click.UsageError("Use either --plan-out or --apply-plan")
+    if plan_out:
+        click.echo("Planning cleaning")
+        roots = [base_folder]
+        if path_select:
+            roots = list(base_folder.glob(path_select))
+        plan_cleaning(roots, workers=jobs).save(Path(plan_out))
+        click.echo(f"Plan stored in {plan_out}")
+        return
+    if apply_plan:
+        plan = CleaningPlan.load(Path(apply_plan))
+        if not all(
+            Path(root).is_relative_to(base_folder.absolute()) for root in plan.roots
+        ):
+            raise click.UsageError(f"Plan {apply_plan} is not for {base_folder}")
+        click.echo("Applying cleaning plan")
+        apply_cleaning_plan(plan)
+        click.echo("Done")
+        return
+
+    click.echo("Cleaning songs")
     if not path_select:
         clean_preimport_folder(base_folder)
+    elif jobs > 1:
+        folders = list(base_folder.glob(path_select))
+        echo_job_summary(run_folder_jobs(clean_folder_job, folders, jobs))
     else:
         for p in base_folder.glob(path_select):
             click.echo(p)
@@ -57,15 +185,34 @@ def clean_folder(folder_path: str, path_select: str) -> None:
     default=None,
     help="Select which subfolders to load to the db",
 )
-def load_backlog_folder_init(folder_path: str, path_select: str) -> None:
+@click.option(
+    "--sync",
+    default=False,
+    is_flag=True,
+    help="Also remove songs from the db that no longer exist in the folder",
+)
+@click.option(
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of subfolders loaded at once, each in its own process",
+)
+def load_backlog_folder_init(
+    folder_path: str, path_select: str, sync: bool, jobs: int
+) -> None:
     click.echo("Loading songs")
     base_folder = Path(folder_path)
+    engine = get_engine()
     if not path_select:
-        load_backlog_folder_files(base_folder, get_engine())
+        load_backlog_folder_files(base_folder, engine, remove_missing=sync)
+    elif jobs > 1:
+        folders = list(base_folder.glob(path_select))
+        job = partial(load_folder_files_job, remove_missing=sync)
+        echo_job_summary(run_folder_jobs(job, folders, jobs))
     else:
         for p in base_folder.glob(path_select):
             click.echo(p)
-            load_backlog_folder_files(p, get_engine())
+            load_backlog_folder_files(p, engine, remove_missing=sync)
     click.echo("Done")
 
 
@@ -75,9 +222,47 @@ def load_backlog_folder_init(folder_path: str, path_select: str) -> None:
     default=None,
     help="String to filter the paths for loading metadata",
 )
-def load_backlog_folder_meta(path_select: str) -> None:
+@click.option(
+    "--workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of processes parsing the song files",
+)
+@click.option(
+    "--resume-after",
+    default=None,
+    help="Continue an interrupted run after the path it printed",
+)
+@click.option(
+    "--content-hash",
+    default=False,
+    is_flag=True,
+    help="Hash the audio content too, needed by dedup-folder --by-content",
+)
+def load_backlog_folder_meta(
+    path_select: str, workers: int, resume_after: str | None, content_hash: bool
+) -> None:
     click.echo("Loading metadata")
-    load_backlog_folder_metadata(get_engine(), path_select=path_select)
+    load_backlog_folder_metadata(
+        get_engine(),
+        path_select=path_select,
+        workers=workers,
+        resume_after=resume_after,
+        content_hash=content_hash,
+    )
+    click.echo("Done")
+
+
+@backlog.command()
+@click.option(
+    "--workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of processes building the song names",
+)
+def rehash(workers: int) -> None:
+    click.echo("Rehashing backlog songs")
+    rehash_backlog_songs(get_engine(), workers=workers)
     click.echo("Done")
 
 
@@ -99,15 +284,25 @@ def delete_folder(path: str, keep_folder: bool) -> None:
 
 @backlog.command()
 @click.argument("path")
-def dedup_folder(path: str) -> None:
+@click.option(
+    "--by-content",
+    default=False,
+    is_flag=True,
+    help="Find byte-identical audio in the backlog and collection instead of names",
+)
+def dedup_folder(path: str, by_content: bool) -> None:
     click.echo("Removing duplicates from folder")
-    dedup_song_folder(Path(path), get_engine())
+    if by_content:
+        dedup_song_folder_by_content(Path(path), get_engine())
+    else:
+        dedup_song_folder(Path(path), get_engine())
     click.echo("Done")
 
 
 @app.group()
-def collection() -> None:
-    pass
+@click.pass_context
+def collection(ctx: click.Context) -> None:
+    set_command(f"{ctx.info_name} {ctx.invoked_subcommand}")
 
 
 @collection.command()
@@ -123,5 +318,17 @@ def sync_collection() -> None:
     click.echo("Done")
 
 
+@app.group(
+    cls=LazyGroup,
+    lazy_commands={
+        "benchmark": "songtools.benchmarks.ingest:main",
+        "generate-library": "songtools.benchmarks.library:main",
+    },
+)
+@click.pass_context
+def dev(ctx: click.Context) -> None:
+    set_command(f"{ctx.info_name} {ctx.invoked_subcommand}")
+
+
 if __name__ == "__main__":
     app()
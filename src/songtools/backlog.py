@@ -1,14 +1,31 @@
+import math
+import os
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 from random import randint
+from typing import Callable, Iterable, Iterator, Sequence
 
 import click
-from songtools.utils import echo
+from songtools.utils import chunked, echo
 from pathlib import Path
 from sqlalchemy.orm import Session
-from sqlalchemy import Engine, select
+from sqlalchemy import Engine, delete, func, or_, select, update
+from songtools.db.bulk import bulk_insert_ignore
 from songtools.db.models import BacklogSong, HeardSong, CollectionSong
 from songtools import config
-
-from songtools.naming import has_cyrillic, build_correct_song_file_name
+from songtools.content_hash import cached_content_hash
+from songtools.metrics import count
+from songtools.profiling import stage, stages_collected
+
+from songtools.naming import (
+    has_cyrillic,
+    build_correct_song_file_name,
+    build_song_names,
+)
+from songtools.song_collection import get_collection_content_hashes
 from songtools.song_file_types import (
     SongFile,
     SUPPORTED_MUSIC_TYPES,
@@ -38,61 +55,120 @@ IRRELEVANT_SUFFIXES = [
 ]
 MUSIC_MIX_MIN_SECONDS = 1000
 SIZE_DIFFERENCE_THRESHOLD_KB = 512
+DB_LOOKUP_CHUNK_SIZE = 5000
 META_FILES = [".DS_Store", "desktop.ini", "booklet.pdf"]
 
 
-def handle_music_files(root_path: Path) -> None:
+FileRule = Callable[[Path], Path | None]
+
+
+def iter_tree_files(root_path: Path) -> Iterator[Path]:
+    """Walk the tree once and yield every file, directory by directory.
+    Each directory is listed before its files are yielded, so a rule can safely
+    rename or remove the yielded file.
+
+    :param Path root_path: Root path to start the walk
+    """
+    walker = os.walk(root_path)
+    while True:
+        with stage("walk"):
+            entry = next(walker, None)
+        if entry is None:
+            return
+        dir_path, _, file_names = entry
+        base = Path(dir_path)
+        count("files_walked", len(file_names))
+        for name in file_names:
+            yield base / name
+
+
+def apply_file_rules(root_path: Path, rules: Sequence[FileRule]) -> None:
+    """Send every file in the tree through an ordered chain of rules.
+    A rule returns the path the next rule should work with (it may have been
+    renamed), or None when the file was removed or fully handled.
+
+    :param Path root_path: Root path to the backlog folder
+    :param rules: Rules applied to each file, in order
+    """
+    if stages_collected():
+        # Timed only when profiling, it is the hottest loop of the cleaning
+        rules = [stage(rule.__name__)(rule) for rule in rules]
+    for f in iter_tree_files(root_path):
+        for rule in rules:
+            f = rule(f)
+            if f is None:
+                break
+
+
+def handle_music_file(f: Path) -> None:
     """Bundle of all functionality that has to be done on a file
     It is a bit more expensive to load the metadata so in here load it once and
     then do all required operations.
 
+    :param Path f: Path to the file
+    """
+    if f.name in META_FILES:
+        echo(f"Skipping meta file {f.stem}", "INFO")
+        return
+
+    try:
+        song = SongFile(f)
+    except UnableToExtractData:
+        echo(f"Can't extract metadata from file {f}", "CHECK")
+        return
+    except UnsupportedSongType:
+        echo(f"Unsupported music file {f}", "CHECK")
+        return
+
+    if remove_music_mixes(f, song):
+        return
+    try:
+        rename_songs_from_metadata(f, song)
+    except OSError as e:
+        echo(f"Can't rename file {f}  || Error: {e}", "ERR")
+
+
+def handle_music_files(root_path: Path) -> None:
+    """Run :func:`handle_music_file` on every file in the tree.
+
     :param Path root_path: Root path to the backlog folder
     """
-    for f in root_path.rglob("*"):
-        if f.is_dir():
-            continue
-        elif f.name in META_FILES:
-            echo(f"Skipping meta file {f.stem}", "INFO")
-            continue
+    apply_file_rules(root_path, [handle_music_file])
 
-        try:
-            song = SongFile(f)
-        except UnableToExtractData:
-            echo(f"Can't extract metadata from file {f}", "CHECK")
-            continue
-        except UnsupportedSongType:
-            echo(f"Unsupported music file {f}", "CHECK")
-            continue
 
-        if remove_music_mixes(f, song):
-            continue
-        try:
-            rename_songs_from_metadata(f, song)
-        except OSError as e:
-            echo(f"Can't rename file {f}  || Error: {e}", "ERR")
+@dataclass
+class PruneStats:
+    visited: int = 0
+    removed: int = 0
 
 
-def remove_empty_folders(root_path: Path) -> None:
-    """Recursively remove all empty folders.
-    It stops at 100 iterations of nesting to prevent any weird infinite loops.
+@stage("remove_empty_folders")
+def remove_empty_folders(root_path: Path) -> PruneStats:
+    """Remove all empty folders and folders that only contain META_FILES.
+    Folders are visited deepest first, so a parent is checked only after all of
+    its children were pruned and the whole tree is handled in one traversal.
+    The root folder itself is kept.
 
     :param Path root_path: Root path to start the search
+    :return: Number of visited and removed folders
     """
-    empties_exists = True
-    nest = 0
-    max_nested = 100
-    while empties_exists and nest < max_nested:
-        empties_exists = False
-        for f in root_path.rglob("*"):
-            if f.is_dir() and not any(f.iterdir()):
-                f.rmdir()
-                empties_exists = True
-            elif f.is_dir() and folder_contains_only_metadata(f):
-                for meta_item in f.iterdir():
-                    meta_item.unlink()
-                f.rmdir()
-                empties_exists = True
-        nest += 1
+    stats = PruneStats()
+    for dir_path, _, _ in os.walk(root_path, topdown=False):
+        folder = Path(dir_path)
+        if folder == root_path:
+            continue
+        stats.visited += 1
+        if folder_contains_only_metadata(folder):
+            for meta_item in folder.iterdir():
+                meta_item.unlink()
+            folder.rmdir()
+            stats.removed += 1
+    count("folders_removed", stats.removed)
+    echo(
+        f"Visited {stats.visited} folders, removed {stats.removed} empty folders",
+        "INFO",
+    )
+    return stats
 
 
 def folder_contains_only_metadata(folder: Path) -> bool:
@@ -102,30 +178,51 @@ def folder_contains_only_metadata(folder: Path) -> bool:
     return True
 
 
-def remove_irrelevant_files(root_path: Path) -> None:
-    """Remove all irrelevant files from the backlog folder.
-    It removes all files that are not music files.
+def remove_irrelevant_file(f: Path) -> Path | None:
+    """Remove the file if it is not a music file.
     This is a blacklist approach rather than a whitelist,
     so I won't delete more exotic music suffixes by accident.
 
+    :param Path f: Path to the file
+    :return: None if the file was removed, the unchanged path otherwise
+    """
+    if f.suffix.lower() in IRRELEVANT_SUFFIXES:
+        echo(f"Removing irrelevant file {f}", "OK")
+        f.unlink()
+        count("deletes")
+        return None
+    return f
+
+
+def remove_irrelevant_files(root_path: Path) -> None:
+    """Remove all irrelevant files from the backlog folder.
+
     :param Path root_path: Root path to the backlog folder
     """
-    for f in root_path.rglob("*"):
-        if f.is_file() and f.suffix.lower() in IRRELEVANT_SUFFIXES:
-            echo(f"Removing irrelevant file {f}", "OK")
-            f.unlink()
+    apply_file_rules(root_path, [remove_irrelevant_file])
+
+
+def remove_file_with_cyrilic(f: Path) -> Path | None:
+    """Remove the file if it has cyrillic characters in its name.
+    It is overwhelmingly Rap and pop that I don't keep.
+
+    :param Path f: Path to the file
+    :return: None if the file was removed, the unchanged path otherwise
+    """
+    if has_cyrillic(f.name):
+        echo(f"Removing cyrillic file {f}", "OK")
+        f.unlink()
+        count("deletes")
+        return None
+    return f
 
 
 def remove_files_with_cyrilic(root_path: Path) -> None:
     """Remove all files that have cyrillic characters in their name.
-    It is overwhelmingly Rap and pop that I don't keep.
 
     :param Path root_path: Root path to the backlog folder
     """
-    for f in root_path.rglob("*"):
-        if f.is_file() and has_cyrillic(f.name):
-            echo(f"Removing cyrillic file {f}", "OK")
-            f.unlink()
+    apply_file_rules(root_path, [remove_file_with_cyrilic])
 
 
 def remove_music_mixes(song_path: Path, song: SongFile) -> bool:
@@ -140,190 +237,593 @@ def remove_music_mixes(song_path: Path, song: SongFile) -> bool:
     if song.duration_seconds > MUSIC_MIX_MIN_SECONDS:
         echo(f"Removing DJ mix {song_path}", "OK")
         song_path.unlink()
+        count("deletes")
         return True
     else:
         return False
 
 
+def lower_file_suffix(f: Path) -> Path:
+    """Lower the file suffix to prevent any issues with case sensitivity.
+
+    :param Path f: Path to the file
+    :return: Path to the file after the rename
+    """
+    if f.suffix.isupper():
+        new_name = f.with_suffix(f.suffix.lower())
+        if new_name != f:
+            f.rename(new_name)
+            count("renames")
+            echo(f"Lowered suffix {f} to {new_name}", "OK")
+            return new_name
+    return f
+
+
 def lower_file_suffixes(root_path: Path) -> None:
     """Lower all file suffixes in the backlog folder.
-    It will lower all file suffixes to prevent any issues with case sensitivity.
 
     :param Path root_path: Root path to the backlog folder
     """
-    for f in root_path.rglob("*"):
-        if f.is_file() and f.suffix.isupper():
-            new_name = f.with_suffix(f.suffix.lower())
-            if new_name != f:
-                f.rename(new_name)
-                echo(f"Lowered suffix {f} to {new_name}", "OK")
+    apply_file_rules(root_path, [lower_file_suffix])
 
 
+CLEANING_RULES: list[FileRule] = [
+    lower_file_suffix,
+    remove_irrelevant_file,
+    remove_file_with_cyrilic,
+    handle_music_file,
+]
+
+
+@stage("clean_preimport_folder")
 def clean_preimport_folder(backlog_folder: Path) -> None:
     """Take the backlog folder and clean it.
     It will:
+     - Lower all file suffixes
      - Remove all irrelevant files from the backlog folder
-     - Rename all songs from metadata (if possible)
+     - Remove all files with cyrillic names
+     - Remove DJ mixes and rename all songs from metadata (if possible)
      - Remove all empty folders recursively
 
-    The order of operations is important!
+    The tree is walked once and every file goes through CLEANING_RULES,
+    so the order of operations is kept per file. The order is important!
 
     :param Path backlog_folder: Root path to the backlog folder
     """
     if not backlog_folder.exists() or not backlog_folder.is_dir():
         echo(f"Folder {backlog_folder} does not exist", "ERR")
         return
-    lower_file_suffixes(backlog_folder)
-    remove_irrelevant_files(backlog_folder)
-    remove_files_with_cyrilic(backlog_folder)
-    handle_music_files(backlog_folder)
+    apply_file_rules(backlog_folder, CLEANING_RULES)
     remove_empty_folders(backlog_folder)
 
 
+@dataclass
+class BacklogSyncStats:
+    found: int = 0
+    inserted: int = 0
+    removed: int = 0
+
+
+@stage("db")
+def list_backlog_song_paths(db_engine: Engine, backlog_folder: Path) -> set[str]:
+    """
+    :param Engine db_engine: Database engine
+    :param Path backlog_folder: Folder inside the backlog
+    :return: Paths of all songs in the db that are inside the folder
+    """
+    prefix = str(backlog_folder.relative_to(config.backlog_path))
+    stm = select(BacklogSong.path)
+    if prefix != ".":
+        stm = stm.where(BacklogSong.path.startswith(prefix + "/", autoescape=True))
+    with Session(db_engine) as session:
+        return set(session.scalars(stm))
+
+
+@stage("load_backlog_folder_files")
 def load_backlog_folder_files(
-    backlog_folder: Path, db_engine: Engine, store_after: int = 10000
-) -> None:
+    backlog_folder: Path,
+    db_engine: Engine,
+    store_after: int = 10000,
+    remove_missing: bool = False,
+) -> BacklogSyncStats:
     """Load all songs from the backlog folder into the db
     This makes it easier to search and filter songs based on metadata.
+    Only paths that are not in the db yet are inserted, so it is safe to run it
+    again on an already loaded folder. With `remove_missing` the songs that
+    are no longer on the disk are removed from the db.
     """
-    counter = 0
+    stats = BacklogSyncStats()
+    existing = list_backlog_song_paths(db_engine, backlog_folder)
+    seen = set()
     songs = []
-    for f in backlog_folder.rglob("*"):
-        if f.is_file() and f.suffix in SUPPORTED_MUSIC_TYPES:
-            path = str(f.relative_to(config.backlog_path))
-            songs.append(BacklogSong(path=path))
-            counter += 1
-            if counter % store_after == 0:
-                with Session(db_engine) as session:
-                    session.add_all(songs)
-                    session.commit()
-                    songs = []
-                echo(f"Loaded {counter} songs", "INFO")
+    for f in iter_tree_files(backlog_folder):
+        if f.suffix not in SUPPORTED_MUSIC_TYPES:
+            continue
+        path = str(f.relative_to(config.backlog_path))
+        seen.add(path)
+        stats.found += 1
+        if path in existing:
+            continue
+        songs.append(path)
+        if len(songs) >= store_after:
+            stats.inserted += store_backlog_paths(db_engine, songs)
+            songs = []
+            echo(f"Loaded {stats.inserted} songs", "INFO")
+    stats.inserted += store_backlog_paths(db_engine, songs)
+
+    if remove_missing:
+        missing = existing - seen
+        with stage("db"), Session(db_engine) as session:
+            for chunk in chunked(missing, store_after):
+                session.execute(delete(BacklogSong).where(BacklogSong.path.in_(chunk)))
+            session.commit()
+        stats.removed = len(missing)
 
-    if songs:
-        with Session(db_engine) as session:
-            session.add_all(songs)
+    echo(
+        f"Loaded {stats.inserted} new songs, removed {stats.removed} missing songs, "
+        f"{stats.found} songs in folder",
+        "INFO",
+    )
+    return stats
+
+
+@stage("db")
+def store_backlog_paths(db_engine: Engine, songs: list[str]) -> int:
+    """Insert new backlog song paths, paths that already exist are skipped.
+    On PostgreSQL the paths are streamed with COPY instead of row inserts.
+
+    :return: Number of paths sent to the db
+    """
+    if not songs:
+        return 0
+    with Session(db_engine) as session:
+        bulk_insert_ignore(session, BacklogSong, ["path"], ((p,) for p in songs))
+        session.commit()
+    return len(songs)
+
+
+BACKLOG_META_FIELDS = (
+    "title",
+    "artists",
+    "bpm",
+    "genre",
+    "duration_seconds",
+    "year",
+    "key",
+    "energy",
+    "file_size_kb",
+    "name_hash",
+)
+
+
+def extract_backlog_song_fields(
+    path: str, content_hash: bool = False
+) -> tuple[str, tuple | None, str | None]:
+    """Parse a backlog song and return its metadata as plain values.
+    It is a module level function so it can run in a worker process.
+
+    :param str path: Path to the song relative to the backlog folder
+    :param content_hash: Add the content hash after the metadata
+    :return: path, values in BACKLOG_META_FIELDS order and an error message
+    """
+    try:
+        song = SongFile(config.backlog_path / Path(path))
+        values = (
+            song.title,
+            ",".join(song.artists),
+            song.bpm,
+            song.genre,
+            song.duration_seconds,
+            song.year,
+            song.key,
+            song.energy,
+            song.file_size_kb,
+            song.name_hash,
+        )
+        if content_hash:
+            values += (song.content_hash,)
+    except Exception as e:
+        return path, None, str(e)
+    return path, values, None
+
+
+@stage("db")
+def store_backlog_metadata(db_engine: Engine, rows: list[dict]) -> None:
+    """Update a batch of backlog songs in one transaction.
+    If the batch fails, rows are stored one by one so a single bad row
+    doesn't throw away the rest of the batch.
+
+    :param Engine db_engine: Database engine
+    :param rows: Dicts with the path and BACKLOG_META_FIELDS values
+    """
+    with Session(db_engine) as session:
+        try:
+            session.execute(update(BacklogSong), rows)
             session.commit()
-    echo(f"Loaded {counter} songs", "INFO")
+            return
+        except Exception:
+            session.rollback()
+
+        for row in rows:
+            try:
+                session.execute(update(BacklogSong), [row])
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                echo(
+                    f"Error loading metadata for {row['path']} || Error: {e}",
+                    "ERR",
+                )
 
 
+@stage("load_backlog_folder_metadata")
 def load_backlog_folder_metadata(
-    db_engine: Engine, path_select: str | None = None
-) -> None:
-    """Load all metadata"""
+    db_engine: Engine,
+    path_select: str | None = None,
+    workers: int = 1,
+    store_after: int = 500,
+    resume_after: str | None = None,
+    content_hash: bool = False,
+) -> str | None:
+    """Load all metadata
+    Songs without metadata are streamed from the db in chunks of `store_after`
+    ordered by path, so memory stays bounded. Files are parsed in a process
+    pool when more than one worker is requested and each chunk is stored in
+    one transaction.
+
+    :param Engine db_engine: Database engine
+    :param path_select: Pattern the song paths have to match (ILIKE)
+    :param workers: Number of processes parsing the files
+    :param store_after: Number of songs loaded and stored at once
+    :param resume_after: Path of the last processed song of an interrupted run
+    :param content_hash: Hash the audio content of the songs too, it reads
+        whole files instead of the tags only. Songs with loaded metadata but
+        without a content hash are loaded again to fill it.
+    :return: Path of the last processed song
+    """
+    if content_hash:
+        filters = [
+            or_(
+                BacklogSong.title == None,  # noqa: E711
+                BacklogSong.content_hash == None,  # noqa: E711
+            )
+        ]
+    else:
+        filters = [BacklogSong.title == None]  # noqa: E711
+    if path_select:
+        filters.append(BacklogSong.path.ilike(path_select))
+    if resume_after:
+        filters.append(BacklogSong.path > resume_after)
+    with stage("db"), Session(db_engine) as session:
+        total = session.scalar(
+            select(func.count()).select_from(BacklogSong).where(*filters)
+        )
+
+    fields = (
+        BACKLOG_META_FIELDS + ("content_hash",) if content_hash else BACKLOG_META_FIELDS
+    )
+    extract = partial(extract_backlog_song_fields, content_hash=content_hash)
+    last_path = resume_after
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        with click.progressbar(length=total, label="Loading metadata for songs") as bar:
+            while paths := fetch_backlog_paths_page(
+                db_engine, filters, last_path, store_after
+            ):
+                if executor:
+                    # Files parsed in the workers are not counted by SongFile
+                    count("files_parsed", len(paths))
+                    chunksize = max(1, len(paths) // (workers * 4))
+                    results = executor.map(extract, paths, chunksize=chunksize)
+                else:
+                    results = map(extract, paths)
+
+                rows = []
+                for path, values, error in results:
+                    if error is not None:
+                        echo(
+                            f"Error loading metadata for {path} || Error: {error}",
+                            "ERR",
+                        )
+                        continue
+                    rows.append({"path": path, **dict(zip(fields, values))})
+                if rows:
+                    store_backlog_metadata(db_engine, rows)
+                last_path = paths[-1]
+                bar.update(len(paths))
+    except BaseException:
+        if last_path:
+            echo(f"Metadata loading stopped, resume after: {last_path}", "CHECK")
+        raise
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    return last_path
+
+
+@stage("db")
+def fetch_backlog_paths_page(
+    db_engine: Engine, filters: list, after: str | None, limit: int
+) -> list[str]:
+    """Fetch one keyset page of backlog song paths ordered by path.
+
+    :param Engine db_engine: Database engine
+    :param filters: Where clauses the songs have to match
+    :param after: Last path of the previous page
+    :param limit: Maximum number of paths in the page
+    """
+    stm = select(BacklogSong.path).where(*filters).order_by(BacklogSong.path)
+    if after is not None:
+        stm = stm.where(BacklogSong.path > after)
     with Session(db_engine) as session:
-        stm = select(BacklogSong).where(BacklogSong.title == None)  # noqa: E711
-        if path_select:
-            stm = stm.where(BacklogSong.path.ilike(path_select))
-        total = session.query(BacklogSong.path).count()
-        items = session.scalars(stm).all()
-        with click.progressbar(
-            items,
-            length=total,
-            label="Loading metadata for songs",
-        ) as bar:
-            for db_song in bar:
-                try:
-                    song = SongFile(config.backlog_path / Path(db_song.path))
-                    db_song.title = song.title
-                    db_song.artists = ",".join(song.artists)
-                    db_song.bpm = song.bpm
-                    db_song.genre = song.genre
-                    db_song.duration_seconds = song.duration_seconds
-                    db_song.year = song.year
-                    db_song.key = song.key
-                    db_song.energy = song.energy
-                    db_song.file_size_kb = song.file_size_kb
-
+        return list(session.scalars(stm.limit(limit)))
+
+
+@stage("rehash_backlog_songs")
+def rehash_backlog_songs(
+    db_engine: Engine, workers: int = 1, store_after: int = 5000
+) -> int:
+    """Recompute name hashes of all backlog songs with loaded metadata from
+    the stored artists and title, without reading the song files.
+    Needed after the naming rules change. Artists are stored joined by a comma,
+    so artist names containing a comma are split. Spaces around the names are
+    stripped like when the metadata is loaded.
+
+    :param Engine db_engine: Database engine
+    :param workers: Number of processes building the names, one pool is used
+        for all pages and every page is split between the workers
+    :param store_after: Number of songs read and updated at once
+    :return: Number of songs with a changed hash
+    """
+    changed = 0
+    chunk_size = max(1, math.ceil(store_after / workers))
+    last_path = None
+    stm = (
+        select(
+            BacklogSong.path,
+            BacklogSong.artists,
+            BacklogSong.title,
+            BacklogSong.name_hash,
+        )
+        .where(BacklogSong.title != None)  # noqa: E711
+        .order_by(BacklogSong.path)
+        .limit(store_after)
+    )
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        with Session(db_engine) as session:
+            while True:
+                page_stm = (
+                    stm
+                    if last_path is None
+                    else stm.where(BacklogSong.path > last_path)
+                )
+                page = session.execute(page_stm).all()
+                if not page:
+                    break
+                built = build_song_names(
+                    (
+                        ([a.strip() for a in artists.split(",")], title)
+                        for _, artists, title, _ in page
+                    ),
+                    chunk_size=chunk_size,
+                    executor=executor,
+                )
+                rows = [
+                    {"path": path, "name_hash": name_hash}
+                    for (path, _, _, old_hash), (_, name_hash) in zip(page, built)
+                    if name_hash != old_hash
+                ]
+                if rows:
+                    session.execute(update(BacklogSong), rows)
                     session.commit()
-                except Exception as e:
-                    session.rollback()
-                    echo(
-                        f"Error loading metadata for {db_song.path} || Error: {e}",
-                        "ERR",
-                    )
-                    continue
+                changed += len(rows)
+                last_path = page[-1].path
+    finally:
+        if executor:
+            executor.shutdown()
+    echo(f"Rehashed backlog songs, {changed} hashes changed", "OK")
+    return changed
 
 
 class InsecureDeleteException(Exception):
     pass
 
 
+@stage("delete_song_folder")
 def delete_song_folder(folder: Path, db_engine: Engine, keep_folder=False) -> None:
-    """Recursively remove all files and store data in the db"""
-    # TODO: implement safeguard
-    for f in folder.iterdir():
-        if f.is_file() and f.stem.startswith("._"):
-            f.unlink()
-        elif f.is_file() and f.suffix in SUPPORTED_MUSIC_TYPES:
-            song = SongFile(f)
-            with Session(db_engine) as session:
-                db_song = session.scalars(
-                    select(HeardSong).where(HeardSong.name_hash == song.name_hash)
-                ).first()
-                if not db_song:
-                    db_song = HeardSong(
-                        name_hash=song.name_hash, file_name=f.name, in_collection=False
-                    )
-                    session.add(db_song)
-                    session.commit()
-
-            f.unlink()
-        elif f.is_file() and f.suffix in IRRELEVANT_SUFFIXES:
-            f.unlink()
-        elif f.is_file():
-            raise InsecureDeleteException(
-                f"Refusing to delete directory, unknown file found: {f}?"
+    """Remove all files in the folder tree and store heard songs in the db
+    The whole tree is checked before anything is touched, an unknown file
+    anywhere in it stops the delete. All heard songs are then stored with one
+    bulk insert and only after that the files and folders are removed.
+    """
+    folders = []
+    music_files = []
+    other_files = []
+    for dir_path, _, file_names in os.walk(folder):
+        folders.append(Path(dir_path))
+        count("files_walked", len(file_names))
+        for name in file_names:
+            f = Path(dir_path) / name
+            if f.stem.startswith("._"):
+                other_files.append(f)
+            elif f.suffix in SUPPORTED_MUSIC_TYPES:
+                music_files.append(f)
+            elif f.suffix in IRRELEVANT_SUFFIXES:
+                other_files.append(f)
+            else:
+                raise InsecureDeleteException(
+                    f"Refusing to delete directory, unknown file found: {f}?"
+                )
+
+    songs = [SongFile(f) for f in music_files]
+    built = build_song_names((song.artists, song.title) for song in songs)
+    heard = {}
+    for f, (_, name_hash) in zip(music_files, built):
+        heard.setdefault(name_hash, f.name)
+    with stage("db"), Session(db_engine) as session:
+        bulk_insert_ignore(
+            session,
+            HeardSong,
+            ["name_hash", "file_name", "in_collection"],
+            [(name_hash, file_name, False) for name_hash, file_name in heard.items()],
+        )
+        session.commit()
+
+    for f in music_files + other_files:
+        f.unlink()
+    count("deletes", len(music_files) + len(other_files))
+    for f in reversed(folders):
+        if f != folder or not keep_folder:
+            f.rmdir()
+            count("folders_removed")
+
+
+@stage("db")
+def lookup_heard_songs(
+    db_engine: Engine, name_hashes: Iterable[str]
+) -> dict[str, tuple[bool, int | None]]:
+    """Find out which songs were heard already, in chunked queries.
+
+    :param Engine db_engine: Database engine
+    :param name_hashes: Name hashes of the songs
+    :return: in_collection flag and collection file size by name hash
+        for every heard song
+    """
+    heard = {}
+    with Session(db_engine) as session:
+        for chunk in chunked(name_hashes, DB_LOOKUP_CHUNK_SIZE):
+            stm = (
+                select(
+                    HeardSong.name_hash,
+                    HeardSong.in_collection,
+                    CollectionSong.file_size,
+                )
+                .outerjoin(
+                    CollectionSong, CollectionSong.name_hash == HeardSong.name_hash
+                )
+                .where(HeardSong.name_hash.in_(chunk))
             )
-        else:
-            delete_song_folder(f, db_engine)
-    if not keep_folder:
-        folder.rmdir()
+            for name_hash, in_collection, file_size in session.execute(stm):
+                heard[name_hash] = (in_collection, file_size)
+    return heard
 
 
+@stage("dedup_song_folder")
 def dedup_song_folder(folder: Path, db_engine: Engine) -> None:
-    """Remove all duplicates from the folder"""
+    """Remove all duplicates from the folder
+    It runs in phases: hash all songs in the folder, look the hashes up in the
+    db in chunks and only then delete the duplicates.
+    """
     # TODO: implement deduplication in folder level, keep the larger item
-    for f in folder.rglob("*"):
-        if (
-            f.is_file()
-            and f.suffix in SUPPORTED_MUSIC_TYPES
-            and not f.stem.startswith("._")
-        ):
+    songs = []
+    for f in iter_tree_files(folder):
+        if f.suffix in SUPPORTED_MUSIC_TYPES and not f.stem.startswith("._"):
             try:
                 song = SongFile(f)
             except UnableToExtractData:
                 continue
+            songs.append((f, song.artists, song.title, song.file_size_kb))
 
-            with Session(db_engine) as session:
-                heard_song = session.scalars(
-                    select(HeardSong).where(HeardSong.name_hash == song.name_hash)
-                ).first()
-                if not heard_song:
-                    continue
-
-                if heard_song.in_collection:
-                    click.secho(f"Song is in collection {f}", fg="green")
-                    collection_song = session.scalars(
-                        select(CollectionSong).where(
-                            CollectionSong.name_hash == song.name_hash
-                        )
-                    ).first()
-                    size_diff = song.file_size_kb - collection_song.file_size
-                    if size_diff > SIZE_DIFFERENCE_THRESHOLD_KB:
-                        click.secho(
-                            f"Collection duplicate improvement Size difference too big {f}",
-                            fg="yellow",
-                        )
-                    else:
-                        click.secho(
-                            f"Collection duplicate - size difference is ok {f} - {size_diff}kb",
-                            fg="green",
-                        )
-                        f.unlink()
-                else:
-                    click.secho(f"Duplicate found {f}", fg="green")
-                    f.unlink()
+    built = build_song_names((artists, title) for _, artists, title, _ in songs)
+    name_hashes = [name_hash for _, name_hash in built]
+    heard = lookup_heard_songs(db_engine, set(name_hashes))
+
+    for (f, _, _, file_size_kb), name_hash in zip(songs, name_hashes):
+        if name_hash not in heard:
+            continue
+
+        in_collection, collection_file_size = heard[name_hash]
+        if in_collection:
+            click.secho(f"Song is in collection {f}", fg="green")
+            if collection_file_size is None:
+                echo(f"Collection song is missing in the db {f}", "CHECK")
+                continue
+            size_diff = file_size_kb - collection_file_size
+            if size_diff > SIZE_DIFFERENCE_THRESHOLD_KB:
+                click.secho(
+                    f"Collection duplicate improvement Size difference too big {f}",
+                    fg="yellow",
+                )
+            else:
+                click.secho(
+                    f"Collection duplicate - size difference is ok {f} - {size_diff}kb",
+                    fg="green",
+                )
+                f.unlink()
+                count("deletes")
+        else:
+            click.secho(f"Duplicate found {f}", fg="green")
+            f.unlink()
+            count("deletes")
+
+
+@stage("db")
+def lookup_backlog_content_hashes(
+    db_engine: Engine, content_hashes: Iterable[str]
+) -> dict[str, set[str]]:
+    """Find backlog songs with the same audio content, in chunked queries.
+
+    :param Engine db_engine: Database engine
+    :param content_hashes: Content hashes of the songs
+    :return: Backlog paths of the songs by content hash
+    """
+    found = defaultdict(set)
+    with Session(db_engine) as session:
+        for chunk in chunked(content_hashes, DB_LOOKUP_CHUNK_SIZE):
+            stm = select(BacklogSong.content_hash, BacklogSong.path).where(
+                BacklogSong.content_hash.in_(chunk)
+            )
+            for content_hash, path in session.execute(stm):
+                found[content_hash].add(path)
+    return found
+
+
+@stage("dedup_song_folder_by_content")
+def dedup_song_folder_by_content(folder: Path, db_engine: Engine) -> None:
+    """Remove songs whose audio is byte-identical to another song
+    Inside the folder the largest copy is kept. Songs are removed too when
+    the same audio is elsewhere in the backlog (songs loaded with content
+    hashes) or in the collection. Tags are not compared at all, differently
+    tagged copies are duplicates while different mixes with the same tags
+    are not.
+    """
+    songs = []
+    for f in iter_tree_files(folder):
+        if f.suffix in SUPPORTED_MUSIC_TYPES and not f.stem.startswith("._"):
+            content_hash = cached_content_hash(f)
+            if content_hash is None:
+                echo(f"Can't hash audio content of {f}", "CHECK")
+                continue
+            songs.append((f, f.stat().st_size, content_hash))
+
+    own_paths = set()
+    if folder.absolute().is_relative_to(config.backlog_path):
+        own_paths = {
+            str(f.absolute().relative_to(config.backlog_path)) for f, _, _ in songs
+        }
+    in_backlog = lookup_backlog_content_hashes(db_engine, {h for _, _, h in songs})
+    in_collection = get_collection_content_hashes()
+
+    kept = set()
+    for f, _, content_hash in sorted(songs, key=lambda s: (-s[1], s[0])):
+        if content_hash in in_collection:
+            click.secho(
+                f"Same audio is in collection {in_collection[content_hash]} {f}",
+                fg="green",
+            )
+        elif any(
+            (Path(config.backlog_path) / p).exists()
+            for p in in_backlog.get(content_hash, set()) - own_paths
+        ):
+            click.secho(f"Same audio is in backlog {f}", fg="green")
+        elif content_hash in kept:
+            click.secho(f"Same audio is in folder {f}", fg="green")
+        else:
+            kept.add(content_hash)
+            continue
+        f.unlink()
+        count("deletes")
 
 
 def rename_songs_from_metadata(song_path: Path, song: SongFile) -> None:
@@ -339,9 +839,11 @@ def rename_songs_from_metadata(song_path: Path, song: SongFile) -> None:
     #       - that's why I have to make a tmp name first
     if new_name.lower() != song_path.stem.lower():
         song_path.rename(song_path.with_stem(new_name))
+        count("renames")
         echo(f"Renamed {song_path} to {new_name}", "OK")
     elif new_name != song_path.stem:
         temp_name = new_name + str(randint(10000000, 99999999))
         song_path = song_path.rename(song_path.with_stem(temp_name))
         song_path.rename(song_path.with_stem(new_name))
+        count("renames")
         echo(f"Fixed song casing {song_path} to {new_name}", "OK")
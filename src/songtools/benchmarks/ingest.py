@@ -0,0 +1,264 @@
+"""Time the ingest pipeline on a generated library against SQLite.
+
+Run with: python -m songtools.benchmarks.ingest --songs 1000 --out results.json
+"""
+
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import click
+from mutagen import flac
+from sqlalchemy import create_engine, Engine
+
+from songtools import config
+from songtools.backlog import (
+    clean_preimport_folder,
+    dedup_song_folder,
+    load_backlog_folder_files,
+    load_backlog_folder_metadata,
+)
+from songtools.conftest import (
+    create_test_mp3_data,
+    make_simple_song_file,
+    MetadataFields,
+)
+from songtools.db.models import Base
+from songtools.song_collection import sync_collection_items
+
+FIXTURES_PATH = Path(__file__).parent.parent / "tests/fixtures"
+RESULTS_FORMAT = "songtools-ingest-benchmark"
+RESULTS_VERSION = 1
+STAGES = ["clean", "load_files", "load_metadata", "sync_collection", "dedup"]
+GENRES = ["House", "Techno", "Disco", "Breaks", "Electro"]
+
+
+def generate_library(
+    folder: Path,
+    songs: int,
+    collection_songs: int,
+    flac_ratio: float = 0.1,
+    long_songs: int = 0,
+    seed: int = 0,
+) -> tuple[Path, Path]:
+    """Generate a backlog and a collection folder with the conftest helpers.
+    The backlog has songs spread in genre folders, junk files and uppercase
+    suffixes to clean, part of the collection songs is also in the backlog so
+    dedup has something to remove.
+
+    :param Path folder: Folder to generate the library in
+    :param songs: Number of songs in the backlog
+    :param collection_songs: Number of songs in the collection
+    :param flac_ratio: Share of the backlog songs stored as FLAC
+    :param long_songs: Number of 15 minute songs in the backlog
+    :param seed: Seed of the random choices
+    :return: Backlog folder and collection folder
+    """
+    rnd = random.Random(seed)
+    backlog_folder = folder / "backlog"
+    collection_folder = folder / "collection"
+    collection_folder.mkdir(parents=True)
+    flac_data = (FIXTURES_PATH / "silence20s.flac").read_bytes()
+
+    for i in range(collection_songs):
+        make_simple_song_file(collection_folder, f"Song {i}", f"Artist {i % 97}")
+
+    for i in range(songs):
+        genre_folder = backlog_folder / f"{rnd.choice(GENRES)}-{2000 + i % 25}"
+        genre_folder.mkdir(parents=True, exist_ok=True)
+        # Every tenth backlog song is a duplicate of a collection song
+        song_id = i if i % 10 or i >= collection_songs else i // 10
+        title, artist = f"Song {song_id}", f"Artist {song_id % 97}"
+        if i < long_songs:
+            make_simple_song_file(
+                genre_folder, title, artist, source="silence15min.mp3"
+            )
+        elif rnd.random() < flac_ratio:
+            song = genre_folder / f"{artist}-{title}.FLAC"
+            song.write_bytes(flac_data)
+            audio = flac.FLAC(song)
+            audio["artist"] = artist
+            audio["title"] = title
+            audio["date"] = "2020"
+            audio.save()
+        else:
+            song = genre_folder / f"{artist.lower()} - {title.lower()}.mp3"
+            song.write_bytes(create_test_mp3_data(MetadataFields(title, artist)))
+        if i % 50 == 0:
+            (genre_folder / "cover.jpg").write_bytes(b"\x00" * 1024)
+            (genre_folder / "release.nfo").write_text("generated")
+    return backlog_folder, collection_folder
+
+
+def time_stage(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run_pipeline(folder: Path, workers: int) -> dict[str, float]:
+    """Run all stages on the library in the folder against a new SQLite db.
+
+    :return: Seconds per stage
+    """
+    backlog_folder = folder / "backlog"
+    engine: Engine = create_engine(f"sqlite:///{folder / 'benchmark.sqlite'}")
+    Base.metadata.create_all(engine)
+    try:
+        return {
+            "clean": time_stage(lambda: clean_preimport_folder(backlog_folder)),
+            "load_files": time_stage(
+                lambda: load_backlog_folder_files(backlog_folder, engine)
+            ),
+            "load_metadata": time_stage(
+                lambda: load_backlog_folder_metadata(engine, workers=workers)
+            ),
+            "sync_collection": time_stage(lambda: sync_collection_items(engine)),
+            "dedup": time_stage(lambda: dedup_song_folder(backlog_folder, engine)),
+        }
+    finally:
+        engine.dispose()
+
+
+def run(
+    songs: int = 1000,
+    collection_songs: int = 500,
+    flac_ratio: float = 0.1,
+    long_songs: int = 0,
+    workers: int = 1,
+    repeat: int = 3,
+    seed: int = 0,
+    verbose: bool = False,
+) -> dict:
+    """Generate the library `repeat` times and time every stage on it.
+    Caches are disabled, so all runs parse every file.
+
+    :return: Results with the parameters and timings of every run
+    """
+    parameters = {
+        "songs": songs,
+        "collection_songs": collection_songs,
+        "flac_ratio": flac_ratio,
+        "long_songs": long_songs,
+        "workers": workers,
+        "repeat": repeat,
+        "seed": seed,
+    }
+    runs = []
+    configured = (
+        config.backlog_path,
+        config.collection_path,
+        config.tag_cache_path,
+        config.collection_snapshot_path,
+    )
+    try:
+        config.tag_cache_path = ""
+        config.collection_snapshot_path = ""
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                folder = Path(tmp)
+                backlog_folder, collection_folder = generate_library(
+                    folder, songs, collection_songs, flac_ratio, long_songs, seed
+                )
+                config.backlog_path = str(backlog_folder)
+                config.collection_path = str(collection_folder)
+                with open(os.devnull, "w") as devnull:
+                    output = sys.stdout if verbose else devnull
+                    with contextlib.redirect_stdout(output):
+                        runs.append(run_pipeline(folder, workers))
+    finally:
+        (
+            config.backlog_path,
+            config.collection_path,
+            config.tag_cache_path,
+            config.collection_snapshot_path,
+        ) = configured
+
+    return {
+        "format": RESULTS_FORMAT,
+        "version": RESULTS_VERSION,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "stages": {
+            stage: {
+                "min": min(r[stage] for r in runs),
+                "median": statistics.median(r[stage] for r in runs),
+                "runs": [r[stage] for r in runs],
+            }
+            for stage in STAGES
+        },
+    }
+
+
+def compare(results: dict, baseline: dict) -> dict[str, float]:
+    """
+    :return: Ratio of the median of every stage to the baseline median
+    """
+    return {
+        stage: timings["median"] / baseline["stages"][stage]["median"]
+        for stage, timings in results["stages"].items()
+        if baseline["stages"].get(stage, {}).get("median")
+    }
+
+
+@click.command()
+@click.option("--songs", default=1000, help="Number of songs in the backlog")
+@click.option("--collection-songs", default=500, help="Number of collection songs")
+@click.option("--flac-ratio", default=0.1, help="Share of FLAC songs in the backlog")
+@click.option("--long-songs", default=0, help="Number of 15 minute backlog songs")
+@click.option(
+    "--workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of processes loading the metadata",
+)
+@click.option("--repeat", default=3, type=click.IntRange(min=1), help="Number of runs")
+@click.option("--seed", default=0, help="Seed of the generated library")
+@click.option("--out", type=click.Path(), help="Store the results as JSON")
+@click.option(
+    "--baseline", type=click.Path(exists=True), help="Results to compare with"
+)
+@click.option("--verbose", is_flag=True, help="Show the output of the stages")
+def main(
+    songs: int,
+    collection_songs: int,
+    flac_ratio: float,
+    long_songs: int,
+    workers: int,
+    repeat: int,
+    seed: int,
+    out: str | None,
+    baseline: str | None,
+    verbose: bool,
+) -> None:
+    results = run(
+        songs, collection_songs, flac_ratio, long_songs, workers, repeat, seed, verbose
+    )
+    ratios = {}
+    if baseline:
+        ratios = compare(results, json.loads(Path(baseline).read_text()))
+
+    click.echo(f"{'stage':<18}{'min s':>10}{'median s':>10}{'vs base':>10}")
+    for stage, timings in results["stages"].items():
+        ratio = f"{ratios[stage]:>9.2f}x" if stage in ratios else ""
+        click.echo(
+            f"{stage:<18}{timings['min']:>10.3f}{timings['median']:>10.3f}{ratio}"
+        )
+    if out:
+        Path(out).write_text(json.dumps(results, indent=2))
+        click.echo(f"Results stored in {out}")
+
+
+if __name__ == "__main__":
+    main()
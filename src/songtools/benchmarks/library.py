@@ -0,0 +1,235 @@
+"""Generate synthetic song libraries for scale testing.
+
+The library is planned from a seed first and written afterwards, so the same
+seed gives the same tree with any number of workers.
+
+Run with: python -m songtools.benchmarks.library /tmp/library --files 100000
+"""
+
+import io
+import os
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+import click
+from mutagen import flac
+
+from songtools.backlog import IRRELEVANT_SUFFIXES, META_FILES, MUSIC_MIX_MIN_SECONDS
+from songtools.conftest import (
+    create_test_m4a_data,
+    create_test_mp3_data,
+    MetadataFields,
+)
+from songtools.utils import chunked
+
+FIXTURES_PATH = Path(__file__).parent.parent / "tests/fixtures"
+# Audio frames kept after the FLAC metadata, tag readers only need the headers
+FLAC_AUDIO_BYTES = 4096
+WRITE_CHUNK_SIZE = 500
+
+GENRES = ["House", "Techno", "Disco", "Breaks", "Electro", "Ambient", "Garage"]
+SYLLABLES = ["ka", "lo", "mi", "ra", "ton", "vel", "dri", "sun", "jo", "ne", "bas"]
+CYRILLIC_SYLLABLES = ["ко", "ла", "ми", "ра", "то", "вел", "дри", "сун"]
+TITLE_WORDS = ["night", "of", "the", "love", "and", "city", "dream", "fire", "is"]
+REMIXES = ["(Original Mix)", "(Extended Mix)", "(Dub)", "(Radio Edit)", ""]
+
+
+@dataclass
+class LibraryEntry:
+    """One planned file, `kind` says how its content is built."""
+
+    path: str
+    kind: str
+    artist: str = ""
+    title: str = ""
+
+
+def _name(rnd: random.Random, syllables: list[str], words: int) -> str:
+    return " ".join(
+        "".join(rnd.choices(syllables, k=rnd.randint(1, 3))).capitalize()
+        for _ in range(words)
+    )
+
+
+def _title(rnd: random.Random, artists: list[str]) -> str:
+    title = " ".join(rnd.choices(TITLE_WORDS, k=rnd.randint(1, 4))).capitalize()
+    if rnd.random() < 0.1:
+        title += f" feat. {rnd.choice(artists)}"
+    return f"{title} {rnd.choice(REMIXES)}".strip()
+
+
+def _song_file_name(rnd: random.Random, number: int, artist: str, title: str) -> str:
+    """File names as they come from different sources, most need a rename."""
+    variant = rnd.random()
+    if variant < 0.4:
+        return f"{artist} - {title}"
+    if variant < 0.6:
+        # Only the casing differs from the correct name
+        return f"{artist} - {title}".lower()
+    if variant < 0.8:
+        return f"{number:02d}_{artist}_{title}".replace(" ", "_")
+    return f"{number:02d}. {artist} - {title}"
+
+
+def plan_library(files: int, seed: int = 0) -> list[LibraryEntry]:
+    """Plan a library of about `files` files.
+    Songs are in nested genre, year and release folders as mp3, flac and m4a
+    with junk and meta files next to them. Some songs have cyrillic names,
+    some are duplicates of earlier songs and some are DJ mixes.
+
+    :param files: Number of files to plan
+    :param seed: Seed of the random choices
+    :return: Planned files
+    """
+    rnd = random.Random(seed)
+    artists = [_name(rnd, SYLLABLES, rnd.randint(1, 2)) for _ in range(files // 20 + 5)]
+    entries: list[LibraryEntry] = []
+    songs: list[tuple[str, str]] = []
+    release_id = 0
+    while len(entries) < files:
+        release_id += 1
+        genre = rnd.choice(GENRES)
+        year = rnd.randint(1990, 2024)
+        release_artist = rnd.choice(artists)
+        folder = (
+            f"{genre}/{genre}-{year}/"
+            f"{release_artist} - {_name(rnd, SYLLABLES, 2)} [{release_id}]"
+        )
+
+        if rnd.random() < 0.02:
+            artist, title = rnd.choice(artists), f"Live Mix {release_id}"
+            entries.append(
+                LibraryEntry(f"{folder}/{artist} - {title}.m4a", "mix", artist, title)
+            )
+            continue
+
+        release_paths = set()
+        for number in range(1, rnd.randint(1, 12) + 1):
+            if songs and rnd.random() < 0.05:
+                artist, title = rnd.choice(songs)
+            elif rnd.random() < 0.02:
+                artist = _name(rnd, CYRILLIC_SYLLABLES, 1)
+                title = _name(rnd, CYRILLIC_SYLLABLES, 2)
+            else:
+                artist = rnd.choice([release_artist, rnd.choice(artists)])
+                title = _title(rnd, artists)
+            songs.append((artist, title))
+
+            kind = rnd.choices(["mp3", "flac", "m4a"], weights=[70, 20, 10])[0]
+            suffix = f".{kind}"
+            if rnd.random() < 0.05:
+                suffix = suffix.upper()
+            name = _song_file_name(rnd, number, artist, title)
+            if f"{folder}/{name}{suffix}" in release_paths:
+                continue
+            release_paths.add(f"{folder}/{name}{suffix}")
+            entries.append(
+                LibraryEntry(f"{folder}/{name}{suffix}", kind, artist, title)
+            )
+            if rnd.random() < 0.02:
+                entries.append(LibraryEntry(f"{folder}/._{name}{suffix}", "apple"))
+
+        for suffix in rnd.sample(IRRELEVANT_SUFFIXES, k=rnd.randint(0, 2)):
+            entries.append(LibraryEntry(f"{folder}/release{suffix}", "junk"))
+        if rnd.random() < 0.1:
+            entries.append(LibraryEntry(f"{folder}/{rnd.choice(META_FILES)}", "junk"))
+    return entries[:files]
+
+
+@lru_cache
+def _flac_payload() -> bytes:
+    """FLAC fixture with only a few audio frames after the metadata blocks."""
+    data = (FIXTURES_PATH / "silence20s.flac").read_bytes()
+    offset = 4
+    last = False
+    while not last:
+        last = bool(data[offset] & 0x80)
+        offset += 4 + int.from_bytes(data[offset + 1 : offset + 4], "big")
+    return data[: offset + FLAC_AUDIO_BYTES]
+
+
+def entry_data(entry: LibraryEntry) -> bytes:
+    if entry.kind == "mp3":
+        return create_test_mp3_data(MetadataFields(entry.title, entry.artist))
+    if entry.kind == "m4a":
+        return create_test_m4a_data(MetadataFields(entry.title, entry.artist))
+    if entry.kind == "mix":
+        return create_test_m4a_data(
+            MetadataFields(entry.title, entry.artist),
+            duration_seconds=MUSIC_MIX_MIN_SECONDS * 4,
+        )
+    if entry.kind == "flac":
+        data = io.BytesIO(_flac_payload())
+        audio = flac.FLAC(data)
+        audio["artist"] = entry.artist
+        audio["title"] = entry.title
+        data.seek(0)
+        audio.save(data)
+        return data.getvalue()
+    if entry.kind == "apple":
+        return b"\x00\x05\x16\x07" + b"\x00" * 78
+    return b"\x00" * 512
+
+
+def write_entries(root: Path, entries: list[LibraryEntry]) -> int:
+    """Write planned files, it runs in the worker processes.
+
+    :return: Number of written files
+    """
+    for entry in entries:
+        path = root / entry.path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(entry_data(entry))
+    return len(entries)
+
+
+def generate_library(
+    root: Path, files: int, seed: int = 0, workers: int = 1
+) -> Counter:
+    """Plan a library and write it to `root`.
+
+    :param Path root: Folder to write the library to
+    :param files: Number of files in the library
+    :param seed: Seed of the random choices
+    :param workers: Number of processes writing the files
+    :return: Number of files by kind
+    """
+    entries = plan_library(files, seed)
+    chunks = list(chunked(entries, WRITE_CHUNK_SIZE))
+    with click.progressbar(length=len(entries), label="Writing files") as bar:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(write_entries, root, c) for c in chunks]
+                for future in futures:
+                    bar.update(future.result())
+        else:
+            for chunk in chunks:
+                bar.update(write_entries(root, chunk))
+    return Counter(entry.kind for entry in entries)
+
+
+@click.command()
+@click.argument("folder", type=click.Path(file_okay=False))
+@click.option("--files", default=10_000, help="Number of files in the library")
+@click.option("--seed", default=0, help="Seed of the generated library")
+@click.option(
+    "--workers",
+    default=os.cpu_count() or 1,
+    type=click.IntRange(min=1),
+    help="Number of processes writing the files",
+)
+def main(folder: str, files: int, seed: int, workers: int) -> None:
+    root = Path(folder)
+    if root.exists() and any(root.iterdir()):
+        raise click.UsageError(f"Folder {root} is not empty")
+    counts = generate_library(root, files, seed, workers)
+    for kind, count in sorted(counts.items()):
+        click.echo(f"{kind:<6}{count:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Compare the mutagen and the fast tag reader on the test fixtures.
+
+Run with: python -m songtools.benchmarks.tag_readers
+"""
+
+import tempfile
+import timeit
+from pathlib import Path
+
+import click
+import mutagen.id3 as mt_id3
+from mutagen import flac
+
+from songtools import config
+from songtools.conftest import create_test_m4a_data, MetadataFields
+from songtools.song_file_types import FlacFile, ID3File, M4AFile, MetaRetriever
+
+FIXTURES_PATH = Path(__file__).parent.parent / "tests/fixtures"
+BACKENDS = ["mutagen", "fast"]
+
+
+def prepare_files(folder: Path) -> dict[str, tuple[type[MetaRetriever], Path]]:
+    """Store tagged copies of the fixtures, artwork included as it is
+    in real libraries.
+
+    :param Path folder: Folder to store the files in
+    :return: Retriever class and path to the file by file type
+    """
+    artwork = b"\x00" * 200_000
+
+    mp3_file = folder / "song.mp3"
+    mp3_file.write_bytes((FIXTURES_PATH / "silence20s.mp3").read_bytes())
+    tags = mt_id3.ID3()
+    tags.add(mt_id3.TPE1(encoding=3, text="JdPouch"))
+    tags.add(mt_id3.TIT2(encoding=3, text="Song uno"))
+    tags.add(mt_id3.TBPM(encoding=0, text="124"))
+    tags.add(mt_id3.TCON(encoding=3, text="House"))
+    tags.add(mt_id3.COMM(encoding=3, lang="eng", desc="", text="8A - Energy 7"))
+    tags.add(mt_id3.APIC(encoding=0, mime="image/jpeg", data=artwork))
+    tags.save(mp3_file)
+
+    flac_file = folder / "song.flac"
+    flac_file.write_bytes((FIXTURES_PATH / "silence20s.flac").read_bytes())
+    audio = flac.FLAC(flac_file)
+    audio["artist"] = "JdPouch"
+    audio["title"] = "Song uno"
+    audio["date"] = "2020"
+    picture = flac.Picture()
+    picture.data = artwork
+    audio.add_picture(picture)
+    audio.save()
+
+    m4a_file = folder / "song.m4a"
+    m4a_file.write_bytes(create_test_m4a_data(MetadataFields("Song uno", "JdPouch")))
+
+    return {
+        "mp3": (ID3File, mp3_file),
+        "flac": (FlacFile, flac_file),
+        "m4a": (M4AFile, m4a_file),
+    }
+
+
+def run(repeat: int = 200) -> dict[str, dict[str, float]]:
+    """
+    :param repeat: Number of reads of every file with every backend
+    :return: Milliseconds per read by file type and backend
+    """
+    results = {}
+    configured_reader = config.tag_reader
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            files = prepare_files(Path(folder))
+            for file_type, (retriever_class, path) in files.items():
+                results[file_type] = {}
+                for backend in BACKENDS:
+                    config.tag_reader = backend
+                    seconds = timeit.timeit(
+                        lambda: retriever_class(path).duration_seconds, number=repeat
+                    )
+                    results[file_type][backend] = seconds / repeat * 1000
+    finally:
+        config.tag_reader = configured_reader
+    return results
+
+
+@click.command()
+@click.option("--repeat", default=200, help="Number of reads of every file")
+def main(repeat: int) -> None:
+    click.echo(f"{'type':<6}{'mutagen ms':>12}{'fast ms':>12}{'speedup':>10}")
+    for file_type, timings in run(repeat).items():
+        click.echo(
+            f"{file_type:<6}{timings['mutagen']:>12.3f}{timings['fast']:>12.3f}"
+            f"{timings['mutagen'] / timings['fast']:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
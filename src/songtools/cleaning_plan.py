@@ -0,0 +1,236 @@
+"""Two-phase cleaning of backlog folders.
+
+Planning only reads: it walks the folders, parses the songs (in parallel if
+asked to) and decides what :func:`songtools.backlog.clean_preimport_folder`
+would do with every file. The plan can be stored, reviewed and applied later,
+applying it does all the renames and deletes directory by directory.
+"""
+
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from random import randint
+
+from songtools.backlog import (
+    IRRELEVANT_SUFFIXES,
+    META_FILES,
+    MUSIC_MIX_MIN_SECONDS,
+    iter_tree_files,
+    remove_empty_folders,
+)
+from songtools.metrics import count
+from songtools.naming import build_correct_song_file_name, has_cyrillic
+from songtools.profiling import stage
+from songtools.song_file_types import (
+    SongFile,
+    UnableToExtractData,
+    UnsupportedSongType,
+)
+from songtools.tag_cache import close_tag_cache
+from songtools.utils import chunked, echo
+
+PLAN_FORMAT = "songtools-cleaning-plan"
+PLAN_VERSION = 2
+
+RENAME = "rename"
+DELETE = "delete"
+
+
+@dataclass
+class CleaningAction:
+    """Rename or delete of one file.
+    Size and mtime of the file at planning time are kept, a file changed since
+    then is skipped when the plan is applied.
+    """
+
+    kind: str
+    source: str
+    reason: str
+    size: int
+    mtime_ns: int
+    target: str | None = None
+
+
+@dataclass
+class CleaningPlan:
+    roots: list[str]
+    actions: list[CleaningAction] = field(default_factory=list)
+    created_at: str = field(
+        default_factory=lambda: datetime.now().isoformat(timespec="seconds")
+    )
+
+    def save(self, path: Path) -> None:
+        content = {
+            "format": PLAN_FORMAT,
+            "version": PLAN_VERSION,
+            "created_at": self.created_at,
+            "roots": self.roots,
+            "actions": [asdict(action) for action in self.actions],
+        }
+        path.write_text(json.dumps(content, indent=1, ensure_ascii=False))
+
+    @classmethod
+    def load(cls, path: Path) -> "CleaningPlan":
+        content = json.loads(path.read_text())
+        if (
+            content.get("format") != PLAN_FORMAT
+            or content.get("version") != PLAN_VERSION
+        ):
+            raise ValueError(f"{path} is not a cleaning plan of version {PLAN_VERSION}")
+        return cls(
+            roots=content["roots"],
+            actions=[CleaningAction(**action) for action in content["actions"]],
+            created_at=content["created_at"],
+        )
+
+
+def plan_file(f: Path) -> CleaningAction | None:
+    """Decide what the cleaning rules do with the file, without touching it.
+    The rules are the same as CLEANING_RULES and are checked in their order,
+    a lowered suffix and a rename from metadata end up in one rename.
+
+    :param Path f: Path to the file
+    :return: Action for the file with absolute paths, None if the file stays
+        as it is
+    """
+    f = f.absolute()
+    stat = f.stat()
+    target = f
+    reasons = []
+
+    def action(kind: str, reason: str | None = None) -> CleaningAction:
+        return CleaningAction(
+            kind=kind,
+            source=str(f),
+            reason="; ".join(reasons + [reason] if reason else reasons),
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            target=str(target) if kind == RENAME else None,
+        )
+
+    if f.suffix.isupper():
+        target = f.with_suffix(f.suffix.lower())
+        reasons.append("lowered suffix")
+    if target.suffix.lower() in IRRELEVANT_SUFFIXES:
+        return action(DELETE, "irrelevant file")
+    if has_cyrillic(target.name):
+        return action(DELETE, "cyrillic name")
+    if target.name in META_FILES:
+        return action(RENAME) if reasons else None
+
+    try:
+        song = SongFile(f)
+    except UnableToExtractData:
+        echo(f"Can't extract metadata from file {f}", "CHECK")
+        return action(RENAME) if reasons else None
+    except UnsupportedSongType:
+        echo(f"Unsupported music file {f}", "CHECK")
+        return action(RENAME) if reasons else None
+
+    if song.duration_seconds > MUSIC_MIX_MIN_SECONDS:
+        return action(DELETE, "DJ mix")
+    new_name = build_correct_song_file_name(song.artists, song.title)
+    if new_name.lower() != target.stem.lower():
+        target = target.with_stem(new_name)
+        return action(RENAME, "name from metadata")
+    if new_name != target.stem:
+        target = target.with_stem(new_name)
+        return action(RENAME, "fixed casing")
+    return action(RENAME) if reasons else None
+
+
+@stage("plan_cleaning")
+def plan_cleaning(roots: list[Path], workers: int = 1) -> CleaningPlan:
+    """Plan the cleaning of the folders, nothing is written.
+
+    :param roots: Folders to clean
+    :param workers: Number of processes reading the files
+    :return: Plan with an action for every file that has to change, paths are
+        absolute so it can be applied from any working directory
+    """
+    roots = [root.absolute() for root in roots]
+    files = [f for root in roots for f in iter_tree_files(root)]
+    plan = CleaningPlan(roots=[str(root) for root in roots])
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_size = max(1, len(files) // (workers * 4))
+            chunks = executor.map(_plan_files, chunked(files, chunk_size))
+            plan.actions = [a for actions in chunks for a in actions]
+    else:
+        plan.actions = [a for a in map(plan_file, files) if a is not None]
+    echo(f"Planned {len(plan.actions)} actions for {len(files)} files", "INFO")
+    return plan
+
+
+def _plan_files(files: list[Path]) -> list[CleaningAction]:
+    """Plan a chunk of files in a worker process, the tag cache of the worker
+    is written when the chunk is done.
+    """
+    try:
+        return [a for a in map(plan_file, files) if a is not None]
+    finally:
+        close_tag_cache()
+
+
+def _unchanged(action: CleaningAction) -> bool:
+    try:
+        stat = os.stat(action.source)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == action.size and stat.st_mtime_ns == action.mtime_ns
+
+
+def _rename(source: Path, target: Path) -> None:
+    # Some filesystems ignore a rename that only changes the casing,
+    # so it goes through a temporary name
+    if source.name.lower() == target.name.lower():
+        temp = source.with_stem(target.stem + str(randint(10000000, 99999999)))
+        source = source.rename(temp)
+    source.rename(target)
+
+
+@stage("apply_cleaning_plan")
+def apply_cleaning_plan(plan: CleaningPlan) -> None:
+    """Apply the plan directory by directory, deletes first so their names are
+    free for the renames. Files that changed since planning are skipped, just
+    like renames to a name that is already taken. Empty folders are removed
+    afterwards.
+
+    :param CleaningPlan plan: Plan to apply
+    """
+
+    def order(action: CleaningAction) -> tuple:
+        return str(Path(action.source).parent), action.kind != DELETE, action.source
+
+    taken: set[str] = set()
+    for action in sorted(plan.actions, key=order):
+        if not _unchanged(action):
+            echo(f"Skipping {action.source}, it changed since planning", "CHECK")
+            continue
+        source = Path(action.source)
+        try:
+            if action.kind == DELETE:
+                source.unlink()
+                count("deletes")
+                echo(f"Removed {source} ({action.reason})", "OK")
+                continue
+            target = Path(action.target)
+            if action.target in taken or (
+                target.exists() and target.name.lower() != source.name.lower()
+            ):
+                echo(f"Skipping {source}, {target.name} already exists", "CHECK")
+                continue
+            _rename(source, target)
+            taken.add(action.target)
+            count("renames")
+            echo(f"Renamed {source} to {target.name} ({action.reason})", "OK")
+        except OSError as e:
+            echo(f"Can't apply {action.kind} of {source} || Error: {e}", "ERR")
+
+    for root in plan.roots:
+        if Path(root).is_dir():
+            remove_empty_folders(Path(root))
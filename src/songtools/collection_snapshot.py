@@ -0,0 +1,141 @@
+import gzip
+import json
+import math
+import os
+
+import click
+from dataclasses import dataclass
+from pathlib import Path
+from songtools.naming import build_song_names
+from songtools.profiling import stage
+from songtools.song_file_types import SongFile, UnableToExtractData
+
+# Bump when the record layout or the naming rules behind the built names change,
+# older snapshots are then ignored and the collection is scanned again.
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FORMAT = "songtools-collection-snapshot"
+
+
+@dataclass
+class SnapshotRecord:
+    """One collection track as it was found by the last scan."""
+
+    path: Path
+    size: int
+    mtime_ns: int
+    artists: list[str]
+    title: str
+    name_hash: str
+    built_name: str
+
+    @property
+    def file_size_kb(self) -> int:
+        return math.ceil(self.size / 1024)
+
+    @classmethod
+    def from_song(
+        cls, song: SongFile, stat: os.stat_result, built: tuple[str, str]
+    ) -> "SnapshotRecord":
+        built_name, name_hash = built
+        return cls(
+            path=song.path.absolute(),
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            artists=song.artists,
+            title=song.title,
+            name_hash=name_hash,
+            built_name=built_name,
+        )
+
+    def to_row(self) -> list:
+        return [
+            str(self.path),
+            self.size,
+            self.mtime_ns,
+            self.artists,
+            self.title,
+            self.name_hash,
+            self.built_name,
+        ]
+
+    @classmethod
+    def from_row(cls, row: list) -> "SnapshotRecord":
+        path, size, mtime_ns, artists, title, name_hash, built_name = row
+        return cls(Path(path), size, mtime_ns, artists, title, name_hash, built_name)
+
+
+@stage("snapshot")
+def load_snapshot(snapshot_path: Path) -> dict[str, SnapshotRecord]:
+    """Load the records of the last scan.
+    A missing, broken or outdated snapshot is ignored.
+
+    :param Path snapshot_path: Path to the snapshot file
+    :return: Records by absolute path
+    """
+    try:
+        with gzip.open(snapshot_path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if (
+                header.get("format") != SNAPSHOT_FORMAT
+                or header.get("version") != SNAPSHOT_VERSION
+            ):
+                return {}
+            records = (SnapshotRecord.from_row(json.loads(line)) for line in f)
+            return {str(r.path): r for r in records}
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+
+
+@stage("snapshot")
+def save_snapshot(snapshot_path: Path, records: list[SnapshotRecord]) -> None:
+    """Store the records, the old snapshot is replaced only once it's written.
+
+    :param Path snapshot_path: Path to the snapshot file
+    :param records: Records of the current scan
+    """
+    tmp_path = snapshot_path.with_name(snapshot_path.name + ".tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        header = {"format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION}
+        f.write(json.dumps(header) + "\n")
+        for record in records:
+            f.write(json.dumps(record.to_row(), ensure_ascii=False) + "\n")
+    os.replace(tmp_path, snapshot_path)
+
+
+def scan_collection(
+    song_paths: list[Path], snapshot_path: Path | None
+) -> list[SnapshotRecord]:
+    """Build records for all songs, reusing the snapshot of the last scan.
+    Only songs whose size or mtime changed since then are parsed again.
+
+    :param song_paths: Paths to all songs in the collection
+    :param snapshot_path: Path to the snapshot file, None to always parse
+    :return: Records of all songs that could be read
+    """
+    previous = load_snapshot(snapshot_path) if snapshot_path else {}
+    records: list[SnapshotRecord | None] = []
+    parsed = []
+    for f in song_paths:
+        stat = f.stat()
+        record = previous.get(str(f.absolute()))
+        if (
+            record
+            and record.size == stat.st_size
+            and record.mtime_ns == stat.st_mtime_ns
+        ):
+            records.append(record)
+            continue
+        try:
+            parsed.append((len(records), SongFile(f), stat))
+            records.append(None)
+        except UnableToExtractData:
+            click.secho(f"Could not extract data from {f}", fg="red")
+
+    # Names of the parsed songs are built in one batch, records keep the order
+    built = build_song_names((song.artists, song.title) for _, song, _ in parsed)
+    for (i, song, stat), names in zip(parsed, built):
+        records[i] = SnapshotRecord.from_song(song, stat, names)
+
+    if snapshot_path:
+        save_snapshot(snapshot_path, records)
+    return records
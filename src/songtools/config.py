@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from pathlib import Path
 
 from environs import Env
 from enum import Enum
@@ -16,6 +17,11 @@ class DbConfig:
     name: str
     user: str
     password: str
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_pre_ping: bool = True
+    # 0 disables the timeout
+    statement_timeout_ms: int = 0
 
 
 class Config:
@@ -25,6 +31,10 @@ class Config:
         name=env.str("DB_NAME"),
         user=env.str("DB_USER"),
         password=env.str("DB_PASS"),
+        pool_size=env.int("DB_POOL_SIZE", 5),
+        max_overflow=env.int("DB_MAX_OVERFLOW", 10),
+        pool_pre_ping=env.bool("DB_POOL_PRE_PING", True),
+        statement_timeout_ms=env.int("DB_STATEMENT_TIMEOUT_MS", 0),
     )
 
     backlog_path: str = env.str("BACKLOG_PATH")
@@ -33,6 +43,23 @@ class Config:
     log_store: bool = env.bool("LOG_SAVE", False)
     log_dir: str = env.str("LOG_DIR_PATH", "/tmp/")
     log_store_type: list[str] = ["CHECK", "WARN", "ERR"]
+    # "text" or "json" (one JSON record per line)
+    log_format: str = env.str("LOG_FORMAT", "text")
+    # Skip terminal output of INFO and OK messages
+    log_quiet: bool = env.bool("LOG_QUIET", False)
+
+    # "mutagen" or "fast" (header-only reader with a mutagen fallback)
+    tag_reader: str = env.str("TAG_READER", "mutagen")
+    # Empty path disables the cache
+    tag_cache_path: str = env.str(
+        "TAG_CACHE_PATH", str(Path(log_dir) / "songtools-tags.sqlite")
+    )
+    tag_cache_max_entries: int = env.int("TAG_CACHE_MAX_ENTRIES", 500_000)
+    # Empty path disables the snapshot
+    collection_snapshot_path: str = env.str(
+        "COLLECTION_SNAPSHOT_PATH",
+        str(Path(log_dir) / "songtools-collection-snapshot.jsonl.gz"),
+    )
 
 
 config = Config()
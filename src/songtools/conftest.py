@@ -1,9 +1,11 @@
 import io
+import struct
 from dataclasses import dataclass
 
 import pytest
 import mutagen.id3 as mt_id3
 from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4
 from pathlib import Path
 
 TEST_FOLDER = "/tmp/songtools_test"
@@ -148,3 +150,43 @@ def create_test_mp3_data(metadata: MetadataFields | bool | None = None) -> bytes
         audio.save(mp3_data)
     mp3_data.seek(0)
     return mp3_data.read()
+
+
+def _mp4_atom(name: bytes, data: bytes = b"", version: int | None = None) -> bytes:
+    if version is not None:
+        data = struct.pack(">I", version << 24) + data
+    return struct.pack(">I4s", 8 + len(data), name) + data
+
+
+def create_test_m4a_data(
+    metadata: MetadataFields | None = None, duration_seconds: int = 20
+) -> bytes:
+    """Create a minimal M4A file with a sound track but no audio samples.
+
+    :return: m4a data that can be stored in a file.
+    """
+    sample_rate = 44100
+    mvhd = _mp4_atom(
+        b"mvhd", struct.pack(">4I", 0, 0, 1000, duration_seconds * 1000), 0
+    )
+    mdhd = _mp4_atom(
+        b"mdhd",
+        struct.pack(">4I", 0, 0, sample_rate, duration_seconds * sample_rate),
+        0,
+    )
+    hdlr = _mp4_atom(b"hdlr", b"\x00" * 4 + b"soun" + b"\x00" * 13, 0)
+    moov = _mp4_atom(
+        b"moov", mvhd + _mp4_atom(b"trak", _mp4_atom(b"mdia", mdhd + hdlr))
+    )
+    m4a_data = io.BytesIO(
+        _mp4_atom(b"ftyp", b"M4A \x00\x00\x02\x00M4A isom") + moov + _mp4_atom(b"mdat")
+    )
+
+    if metadata is not None:
+        audio = MP4(m4a_data)
+        audio.add_tags()
+        audio["\xa9nam"] = metadata.title
+        audio["\xa9ART"] = metadata.artist
+        m4a_data.seek(0)
+        audio.save(m4a_data)
+    return m4a_data.getvalue()
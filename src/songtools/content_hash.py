@@ -0,0 +1,207 @@
+"""Hash of the audio payload of a song file.
+
+Only the audio data is hashed, the tag regions (ID3v2/ID3v1/APE tags, FLAC
+metadata blocks, MP4 atoms outside mdat, RIFF chunks other than data) are
+skipped. Copies of the same audio with different tags get the same hash.
+Files are mapped into memory and hashed in chunks, so no large reads are done.
+"""
+
+import hashlib
+import mmap
+import sqlite3
+
+from pathlib import Path
+
+from songtools.metrics import count
+from songtools.profiling import stage
+from songtools.tag_cache import get_tag_cache
+
+CONTENT_HASH_CHUNK_SIZE = 1 << 20
+
+ID3V1_SIZE = 128
+APE_FOOTER_SIZE = 32
+
+
+class PayloadNotFound(Exception):
+    pass
+
+
+def _syncsafe(data: bytes) -> int:
+    if any(b & 0x80 for b in data):
+        raise PayloadNotFound("Invalid syncsafe integer")
+    return data[0] << 21 | data[1] << 14 | data[2] << 7 | data[3]
+
+
+def _skip_id3v2(data: mmap.mmap, start: int) -> int:
+    """Skip ID3v2 tags at the start, some files have more than one."""
+    while data[start : start + 3] == b"ID3":
+        has_footer = data[start + 5] & 0x10
+        start += (
+            10 + _syncsafe(data[start + 6 : start + 10]) + (10 if has_footer else 0)
+        )
+    return start
+
+
+def _strip_trailing_tags(data: mmap.mmap, start: int, end: int) -> int:
+    """Strip ID3v1, APEv2 and appended ID3v2 tags from the end."""
+    while True:
+        length = end - start
+        if length >= ID3V1_SIZE and data[end - ID3V1_SIZE : end - 125] == b"TAG":
+            end -= ID3V1_SIZE
+        elif (
+            length >= APE_FOOTER_SIZE
+            and data[end - APE_FOOTER_SIZE : end - 24] == b"APETAGEX"
+        ):
+            # The size includes the footer but not the optional header
+            size = int.from_bytes(data[end - 20 : end - 16], "little")
+            flags = int.from_bytes(data[end - 12 : end - 8], "little")
+            has_header = flags & 0x80000000
+            end -= max(size, APE_FOOTER_SIZE) + (APE_FOOTER_SIZE if has_header else 0)
+        elif length >= 10 and data[end - 10 : end - 7] == b"3DI":
+            end -= 20 + _syncsafe(data[end - 4 : end])
+        else:
+            return end
+        if end < start:
+            raise PayloadNotFound("Trailing tag is larger than the file")
+
+
+def _mpeg_ranges(data: mmap.mmap) -> list[tuple[int, int]]:
+    start = _skip_id3v2(data, 0)
+    return [(start, _strip_trailing_tags(data, start, len(data)))]
+
+
+def _flac_ranges(data: mmap.mmap) -> list[tuple[int, int]]:
+    offset = _skip_id3v2(data, 0)
+    if data[offset : offset + 4] != b"fLaC":
+        raise PayloadNotFound("Not a FLAC stream")
+    offset += 4
+    last = False
+    while not last:
+        if offset + 4 > len(data):
+            raise PayloadNotFound("Unexpected end of FLAC metadata")
+        last = bool(data[offset] & 0x80)
+        offset += 4 + int.from_bytes(data[offset + 1 : offset + 4], "big")
+    return [(offset, _strip_trailing_tags(data, offset, len(data)))]
+
+
+def _mp4_ranges(data: mmap.mmap) -> list[tuple[int, int]]:
+    """Content of the top level mdat atoms, tags live in the moov atom."""
+    ranges = []
+    offset = 0
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset : offset + 4], "big")
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[offset + 8 : offset + 16], "big")
+            header = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header:
+            raise PayloadNotFound(f"Invalid atom size at {offset}")
+        if data[offset + 4 : offset + 8] == b"mdat":
+            ranges.append((offset + header, offset + size))
+        offset += size
+    if not ranges:
+        raise PayloadNotFound("No mdat atom")
+    return ranges
+
+
+def _riff_ranges(data: mmap.mmap) -> list[tuple[int, int]]:
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        # Some .wav files are MPEG streams in disguise
+        return _mpeg_ranges(data)
+    offset = 12
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset + 4 : offset + 8], "little")
+        if data[offset : offset + 4] == b"data":
+            return [(offset + 8, offset + 8 + size)]
+        offset += 8 + size + size % 2
+    raise PayloadNotFound("No data chunk")
+
+
+PAYLOAD_READERS = {
+    ".mp3": _mpeg_ranges,
+    ".wav": _riff_ranges,
+    ".flac": _flac_ranges,
+    ".m4a": _mp4_ranges,
+    ".mp4": _mp4_ranges,
+}
+
+
+def audio_payload_ranges(data: mmap.mmap, suffix: str) -> list[tuple[int, int]]:
+    """
+    :param data: Content of the song file
+    :param suffix: Lowercase suffix of the song file
+    :return: Start and end offsets of the audio payload
+    :raises PayloadNotFound: If the payload can't be located
+    """
+    reader = PAYLOAD_READERS.get(suffix)
+    if reader is None:
+        raise PayloadNotFound(f"Unsupported suffix {suffix}")
+    ranges = reader(data)
+    if any(not 0 <= start <= end <= len(data) for start, end in ranges):
+        raise PayloadNotFound("Payload is out of the file")
+    return ranges
+
+
+@stage("content hash")
+def audio_content_hash(path: Path) -> str | None:
+    """Hash the audio payload of the song file.
+
+    :param Path path: Path to the song file
+    :return: Hex digest of the payload, None if the file can't be hashed
+    """
+    try:
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+        ):
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            ranges = audio_payload_ranges(data, path.suffix.lower())
+            # blake2b is faster than md5 on 64-bit machines
+            digest = hashlib.blake2b(digest_size=16)
+            with memoryview(data) as view:
+                for start, end in ranges:
+                    for offset in range(start, end, CONTENT_HASH_CHUNK_SIZE):
+                        chunk_end = min(offset + CONTENT_HASH_CHUNK_SIZE, end)
+                        digest.update(view[offset:chunk_end])
+                        count("bytes_hashed", chunk_end - offset)
+    except (OSError, ValueError, IndexError, PayloadNotFound):
+        # Empty files can't be mapped and raise ValueError,
+        # truncated tags raise IndexError
+        return None
+    count("files_hashed")
+    return digest.hexdigest()
+
+
+def cached_content_hash(path: Path) -> str | None:
+    """:func:`audio_content_hash` kept in the tag cache next to the tags of
+    the file, keyed by the path, size and mtime like the tags.
+
+    :param Path path: Path to the song file
+    :return: Hex digest of the payload, None if the file can't be hashed
+    """
+    cache = get_tag_cache()
+    if cache is None:
+        return audio_content_hash(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    try:
+        with stage("tag cache"):
+            content_hash = cache.get_content_hash(path, stat)
+    except sqlite3.OperationalError:
+        # A locked cache is a miss, the file is hashed instead
+        count("tag_cache_errors")
+        content_hash = None
+    if content_hash is None:
+        content_hash = audio_content_hash(path)
+        if content_hash is not None:
+            try:
+                with stage("tag cache"):
+                    cache.put_content_hash(path, stat, content_hash)
+            except sqlite3.OperationalError:
+                count("tag_cache_errors")
+    return content_hash
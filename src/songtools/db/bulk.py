@@ -0,0 +1,110 @@
+from typing import Iterable, Sequence
+
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
+
+from songtools.utils import chunked
+
+LOOKUP_CHUNK_SIZE = 1000
+
+
+def insert_ignore(session: Session, model, rows: list[dict]) -> None:
+    """Insert rows and skip those that already exist
+    (INSERT ... ON CONFLICT DO NOTHING). Dialects without it look the
+    primary keys up first, see :func:`insert_missing`.
+
+    :param Session session: Session to execute the insert in
+    :param model: Mapped model class
+    :param rows: Rows to insert as dicts of column values
+    """
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stm = postgresql.insert(model)
+    elif dialect == "sqlite":
+        stm = sqlite.insert(model)
+    else:
+        insert_missing(session, model, rows)
+        return
+    session.execute(stm.on_conflict_do_nothing(), rows)
+
+
+def insert_missing(session: Session, model, rows: list[dict]) -> None:
+    """Insert the rows whose primary key is not in the table yet.
+    Works on any dialect, but unlike ON CONFLICT it only checks the primary
+    key and a concurrent insert of the same key can still fail.
+
+    :param Session session: Session to execute the insert in
+    :param model: Mapped model class
+    :param rows: Rows to insert as dicts of column values
+    """
+    key_columns = list(model.__table__.primary_key.columns)
+    by_key = {}
+    for row in rows:
+        by_key.setdefault(tuple(row[c.name] for c in key_columns), row)
+
+    existing = set()
+    for chunk in chunked(by_key, LOOKUP_CHUNK_SIZE):
+        if len(key_columns) == 1:
+            condition = key_columns[0].in_([key for key, in chunk])
+        else:
+            condition = tuple_(*key_columns).in_(chunk)
+        existing.update(
+            tuple(row) for row in session.execute(select(*key_columns).where(condition))
+        )
+
+    missing = [row for key, row in by_key.items() if key not in existing]
+    if missing:
+        session.execute(insert(model), missing)
+
+
+def copy_insert_ignore(
+    session: Session, model, columns: Sequence[str], rows: Iterable[tuple]
+) -> None:
+    """Stream rows through COPY into a temporary staging table and merge them
+    into the model table, skipping rows that already exist. PostgreSQL only.
+    The staging table is dropped with the transaction.
+
+    :param Session session: Session to execute the copy in
+    :param model: Mapped model class
+    :param columns: Names of the copied columns
+    :param rows: Tuples of values in `columns` order
+    """
+    table = model.__table__.name
+    staging = f"{table}_staging"
+    column_list = ", ".join(columns)
+
+    connection = session.connection()
+    connection.exec_driver_sql(
+        f"CREATE TEMP TABLE IF NOT EXISTS {staging} "
+        f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+    )
+    driver_connection = connection.connection.driver_connection
+    with driver_connection.cursor() as cursor:
+        with cursor.copy(f"COPY {staging} ({column_list}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+    connection.exec_driver_sql(
+        f"INSERT INTO {table} ({column_list}) "
+        f"SELECT {column_list} FROM {staging} ON CONFLICT DO NOTHING"
+    )
+    connection.exec_driver_sql(f"TRUNCATE {staging}")
+
+
+def bulk_insert_ignore(
+    session: Session, model, columns: Sequence[str], rows: Iterable[tuple]
+) -> None:
+    """Insert rows skipping the existing ones with the fastest way the db offers.
+    COPY is used on PostgreSQL, other dialects fall back to a multi-row insert.
+
+    :param Session session: Session to execute the insert in
+    :param model: Mapped model class
+    :param columns: Names of the inserted columns
+    :param rows: Tuples of values in `columns` order
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        copy_insert_ignore(session, model, columns, rows)
+    else:
+        insert_ignore(session, model, [dict(zip(columns, row)) for row in rows])
@@ -22,6 +22,8 @@ class BacklogSong(Base):
     key: Mapped[str] = mapped_column(String(5), nullable=True)
     energy: Mapped[int] = mapped_column(Integer, nullable=True)
     file_size_kb: Mapped[int] = mapped_column(Integer, nullable=True)
+    name_hash: Mapped[str] = mapped_column(String(300), nullable=True, index=True)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=True, index=True)
 
 
 class HeardSong(Base):
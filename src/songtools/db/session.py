@@ -1,11 +1,28 @@
+import os
+
+from dataclasses import dataclass
 from environs import Env
-from sqlalchemy import create_engine, Engine
+from sqlalchemy import create_engine, event, Engine
 from songtools import config
+from songtools.metrics import count
 
 env = Env()
 
 
-def get_engine() -> Engine:
+@dataclass
+class PoolUsage:
+    connects: int = 0
+    checkouts: int = 0
+    checked_out: int = 0
+    max_checked_out: int = 0
+
+
+_engine: Engine | None = None
+_engine_pid: int | None = None
+_pool_usage = PoolUsage()
+
+
+def create_db_engine() -> Engine:
     # Only supporting postgres for this project
     db_host = config.db.host
     db_port = config.db.port
@@ -17,7 +34,71 @@ def get_engine() -> Engine:
         f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
     )
 
-    return create_engine(db_url)
+    connect_args = {}
+    if config.db.statement_timeout_ms:
+        connect_args["options"] = (
+            f"-c statement_timeout={config.db.statement_timeout_ms}"
+        )
+
+    engine = create_engine(
+        db_url,
+        pool_size=config.db.pool_size,
+        max_overflow=config.db.max_overflow,
+        pool_pre_ping=config.db.pool_pre_ping,
+        connect_args=connect_args,
+    )
+    track_pool_usage(engine)
+    return engine
+
+
+def get_engine() -> Engine:
+    """Return the engine shared by the whole process, created on first use.
+    A forked worker process gets its own engine, pooled connections can't be
+    shared between processes.
+    """
+    global _engine, _engine_pid
+    if _engine is None or _engine_pid != os.getpid():
+        _engine = create_db_engine()
+        _engine_pid = os.getpid()
+    return _engine
+
+
+def dispose_engine() -> None:
+    """Close all pooled connections of the shared engine.
+    In a forked worker the engine of the parent is only detached, its
+    connections stay open for the parent that still uses them.
+    """
+    global _engine, _engine_pid
+    if _engine is not None:
+        _engine.dispose(close=_engine_pid == os.getpid())
+    _engine = None
+    _engine_pid = None
+
+
+def track_pool_usage(engine: Engine) -> None:
+    """Count connections and checkouts of the engine pool in `pool_usage()`."""
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record) -> None:
+        _pool_usage.connects += 1
+        count("db_connections")
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+        _pool_usage.checkouts += 1
+        _pool_usage.checked_out += 1
+        _pool_usage.max_checked_out = max(
+            _pool_usage.max_checked_out, _pool_usage.checked_out
+        )
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record) -> None:
+        _pool_usage.checked_out -= 1
+
+
+def pool_usage() -> PoolUsage:
+    """Connections opened and checked out by the tracked engines so far."""
+    return PoolUsage(**vars(_pool_usage))
 
 
 def get_in_memory_engine() -> Engine:
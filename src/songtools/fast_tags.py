@@ -0,0 +1,338 @@
+"""Header-only tag readers.
+
+They read just the tag region of a file (ID3v2 frames, FLAC metadata blocks,
+MP4 moov atoms) and skip everything else, e.g. embedded artwork. The result
+has the same shape as the mutagen objects the MetaRetriever implementations
+use. Anything the readers can't parse makes them return None, the caller then
+falls back to mutagen.
+"""
+
+import re
+import struct
+
+import mutagen.id3 as mt_id3
+from mutagen import MutagenError
+from mutagen.mp3 import MPEGInfo
+from pathlib import Path
+from types import SimpleNamespace
+from typing import BinaryIO
+
+ID3_FRAMES = {"TPE1", "TIT2", "TBPM", "TKEY", "TCON", "TDRC", "TYER", "COMM", "TXXX"}
+ID3_FRAME_ID = re.compile(rb"[A-Z0-9]{4}")
+ID3_ENCODINGS = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}
+# Frame format flags we don't decode: grouping, compression, encryption,
+# unsynchronisation and data length indicator in v2.4 or
+# compression, encryption and grouping in v2.3
+ID3_UNSUPPORTED_FRAME_FLAGS = {4: 0x4F, 3: 0xE0}
+
+FLAC_STREAMINFO = 0
+FLAC_VORBIS_COMMENT = 4
+
+MP4_CONTAINERS = {b"moov", b"trak", b"mdia", b"udta", b"ilst"}
+MP4_TEXT_ATOMS = {b"\xa9ART", b"\xa9nam", b"\xa9day", b"\xa9cmt", b"\xa9gen"}
+
+
+class FastReadError(Exception):
+    pass
+
+
+class FastTags(dict):
+    """Tags read by the fast reader with the stream length in `info`."""
+
+    def __init__(self, tags: dict, length: float) -> None:
+        super().__init__(tags)
+        self.info = SimpleNamespace(length=length)
+
+
+def read_id3(path: Path) -> FastTags | None:
+    return _read_with_fallback(path, _read_id3)
+
+
+def read_flac(path: Path) -> FastTags | None:
+    return _read_with_fallback(path, _read_flac)
+
+
+def read_mp4(path: Path) -> FastTags | None:
+    return _read_with_fallback(path, _read_mp4)
+
+
+def _read_with_fallback(path: Path, reader) -> FastTags | None:
+    try:
+        with open(path, "rb") as f:
+            return reader(f)
+    except (FastReadError, MutagenError, OSError, ValueError, IndexError, struct.error):
+        return None
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise FastReadError("Unexpected end of file")
+    return data
+
+
+def _syncsafe(data: bytes) -> int:
+    if any(b & 0x80 for b in data):
+        raise FastReadError("Invalid syncsafe integer")
+    return data[0] << 21 | data[1] << 14 | data[2] << 7 | data[3]
+
+
+def _read_id3(f: BinaryIO) -> FastTags:
+    header = _read_exact(f, 10)
+    if header[:3] != b"ID3":
+        raise FastReadError("No ID3v2 tag")
+    version, flags = header[3], header[5]
+    if version not in (3, 4) or flags & 0x80:
+        raise FastReadError("Unsupported ID3v2 version or unsynchronisation")
+    tag_end = 10 + _syncsafe(header[6:10])
+
+    if flags & 0x40:
+        ext_size = _read_exact(f, 4)
+        if version == 4:
+            f.seek(_syncsafe(ext_size) - 4, 1)
+        else:
+            f.seek(struct.unpack(">I", ext_size)[0], 1)
+
+    tags = {}
+    while f.tell() + 10 <= tag_end:
+        frame_header = _read_exact(f, 10)
+        frame_id = frame_header[:4]
+        if frame_id[0] == 0:
+            break
+        if not ID3_FRAME_ID.fullmatch(frame_id):
+            raise FastReadError(f"Invalid frame {frame_id!r}")
+        if version == 4:
+            size = _syncsafe(frame_header[4:8])
+        else:
+            size = struct.unpack(">I", frame_header[4:8])[0]
+        if f.tell() + size > tag_end:
+            raise FastReadError("Frame exceeds the tag")
+
+        name = frame_id.decode()
+        if name not in ID3_FRAMES:
+            f.seek(size, 1)
+            continue
+        if frame_header[9] & ID3_UNSUPPORTED_FRAME_FLAGS[version]:
+            raise FastReadError(f"Unsupported flags of frame {name}")
+        frame = _parse_id3_frame(name, _read_exact(f, size))
+        tags.setdefault(frame.HashKey, frame)
+
+    if "TDRC" not in tags and "TYER" in tags:
+        year = tags.pop("TYER").text[0]
+        if re.match(r"[0-9]{4}(-[0-9]{2}-[0-9]{2})?\Z", year):
+            tags["TDRC"] = mt_id3.TDRC(encoding=0, text=[year])
+    if "TCON" in tags:
+        tags["TCON"].genres = tags["TCON"].genres
+
+    # mutagen merges ID3v1 tags into the v2 ones
+    f.seek(-128, 2)
+    if f.read(3) == b"TAG":
+        raise FastReadError("ID3v1 tag present")
+
+    f.seek(tag_end)
+    info = MPEGInfo(f, offset=tag_end)
+    return FastTags(tags, info.length)
+
+
+def _parse_id3_frame(name: str, data: bytes) -> mt_id3.Frame:
+    encoding = data[0]
+    if encoding not in ID3_ENCODINGS:
+        raise FastReadError(f"Unknown encoding {encoding}")
+    if name == "COMM":
+        lang = data[1:4].decode("latin-1")
+        desc, text = _split_terminated(data[4:], encoding)
+        return mt_id3.COMM(
+            encoding=encoding, lang=lang, desc=desc, text=_decode_texts(text, encoding)
+        )
+    if name == "TXXX":
+        desc, text = _split_terminated(data[1:], encoding)
+        return mt_id3.TXXX(
+            encoding=encoding, desc=desc, text=_decode_texts(text, encoding)
+        )
+    return mt_id3.Frames[name](
+        encoding=encoding, text=_decode_texts(data[1:], encoding)
+    )
+
+
+def _split_terminated(data: bytes, encoding: int) -> tuple[str, bytes]:
+    """Split a null terminated string from the rest of the frame data."""
+    if encoding in (1, 2):
+        end = 0
+        while True:
+            end = data.find(b"\x00\x00", end)
+            if end == -1 or end % 2 == 0:
+                break
+            end += 1
+        width = 2
+    else:
+        end = data.find(b"\x00")
+        width = 1
+    if end == -1:
+        raise FastReadError("Missing string terminator")
+    return _decode(data[:end], encoding), data[end + width :]
+
+
+def _decode_texts(data: bytes, encoding: int) -> list[str]:
+    text = _decode(data, encoding).rstrip("\x00")
+    return [value.lstrip("\ufeff") for value in text.split("\x00")]
+
+
+def _decode(data: bytes, encoding: int) -> str:
+    if encoding == 1 and not data:
+        return ""
+    return data.decode(ID3_ENCODINGS[encoding])
+
+
+def _read_flac(f: BinaryIO) -> FastTags:
+    if _read_exact(f, 4) != b"fLaC":
+        raise FastReadError("Not a FLAC stream")
+
+    length = None
+    tags = {}
+    last = False
+    while not last:
+        block_header = _read_exact(f, 4)
+        last = bool(block_header[0] & 0x80)
+        block_type = block_header[0] & 0x7F
+        size = int.from_bytes(block_header[1:4], "big")
+        if block_type == FLAC_STREAMINFO:
+            data = _read_exact(f, size)
+            sample_rate = int.from_bytes(data[10:13], "big") >> 4
+            samples = int.from_bytes(data[13:18], "big") & 0xFFFFFFFFF
+            length = samples / sample_rate if sample_rate else 0
+        elif block_type == FLAC_VORBIS_COMMENT:
+            _parse_vorbis_comment(_read_exact(f, size), tags)
+        else:
+            f.seek(size, 1)
+
+    if length is None:
+        raise FastReadError("Missing STREAMINFO block")
+    return FastTags(tags, length)
+
+
+def _parse_vorbis_comment(data: bytes, tags: dict) -> None:
+    vendor_length = struct.unpack_from("<I", data)[0]
+    pos = 4 + vendor_length
+    count = struct.unpack_from("<I", data, pos)[0]
+    pos += 4
+    for _ in range(count):
+        length = struct.unpack_from("<I", data, pos)[0]
+        pos += 4
+        comment = data[pos : pos + length].decode("utf-8", "replace")
+        pos += length
+        key, sep, value = comment.partition("=")
+        if not sep:
+            raise FastReadError("Invalid vorbis comment")
+        tags.setdefault(key.lower(), []).append(value)
+
+
+def _iter_atoms(f: BinaryIO, end: int | None):
+    """Yield name, data offset and data size of atoms until `end`."""
+    while end is None or f.tell() + 8 <= end:
+        offset = f.tell()
+        header = f.read(8)
+        if not header and end is None:
+            return
+        if len(header) != 8:
+            raise FastReadError("Truncated atom")
+        size, name = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", _read_exact(f, 8))[0]
+            header_size = 16
+        elif size == 0:
+            if end is not None:
+                raise FastReadError("Atom without size")
+            size = f.seek(0, 2) - offset
+        if size < header_size:
+            raise FastReadError(f"Invalid atom size of {name!r}")
+        yield name, offset + header_size, size - header_size
+        f.seek(offset + size)
+
+
+def _read_mp4(f: BinaryIO) -> FastTags:
+    for name, offset, size in _iter_atoms(f, None):
+        if name == b"moov":
+            f.seek(offset)
+            return _parse_moov(f, offset + size)
+    raise FastReadError("No moov atom")
+
+
+def _parse_moov(f: BinaryIO, end: int) -> FastTags:
+    found = {"tags": None, "length": None, "mvhd_length": None}
+    _walk_mp4(f, end, found)
+    length = found["length"]
+    if length is None:
+        length = found["mvhd_length"]
+    if found["tags"] is None or length is None:
+        raise FastReadError("Missing tags or audio track")
+    return FastTags(found["tags"], length)
+
+
+def _walk_mp4(f: BinaryIO, end: int, found: dict, track: dict | None = None) -> None:
+    for name, offset, size in _iter_atoms(f, end):
+        if name == b"trak":
+            track = {}
+            f.seek(offset)
+            _walk_mp4(f, offset + size, found, track)
+            if track.get("handler") == b"soun" and found["length"] is None:
+                found["length"] = track.get("length")
+        elif name == b"mvhd":
+            found["mvhd_length"] = _parse_duration_atom(_read_exact(f, size), 12)
+        elif name == b"mdhd" and track is not None:
+            track["length"] = _parse_duration_atom(_read_exact(f, size), 12)
+        elif name == b"hdlr" and track is not None:
+            track["handler"] = _read_exact(f, size)[8:12]
+        elif name == b"meta":
+            f.seek(offset + 4)
+            _walk_mp4(f, offset + size, found)
+        elif name == b"ilst":
+            found["tags"] = _parse_ilst(f, offset + size)
+        elif name in MP4_CONTAINERS:
+            f.seek(offset)
+            _walk_mp4(f, offset + size, found, track)
+
+
+def _parse_duration_atom(data: bytes, v0_offset: int) -> float:
+    """Duration of mvhd and mdhd full atoms."""
+    version = data[0]
+    if version == 0:
+        unit, length = struct.unpack_from(">2I", data, v0_offset)
+    elif version == 1:
+        unit, length = struct.unpack_from(">IQ", data, 20)
+    else:
+        raise FastReadError(f"Unknown atom version {version}")
+    return length / unit if unit else 0
+
+
+def _parse_ilst(f: BinaryIO, end: int) -> dict:
+    tags = {}
+    for name, offset, size in _iter_atoms(f, end):
+        if name not in MP4_TEXT_ATOMS and name not in (b"tmpo", b"gnre"):
+            continue
+        key = "\xa9gen" if name == b"gnre" else name.decode("latin-1")
+        for flags, data in _parse_mp4_data(_read_exact(f, size)):
+            if name == b"tmpo":
+                value = int.from_bytes(data, "big", signed=True)
+            elif name == b"gnre":
+                # Unknown genre ids are skipped like mutagen does
+                genre_id = int.from_bytes(data, "big")
+                if not 1 <= genre_id <= len(mt_id3.TCON.GENRES):
+                    continue
+                value = mt_id3.TCON.GENRES[genre_id - 1]
+            elif flags in (0, 1):
+                value = data.decode("utf-8")
+            else:
+                raise FastReadError(f"Unexpected data type of {name!r}")
+            tags.setdefault(key, []).append(value)
+    return tags
+
+
+def _parse_mp4_data(data: bytes):
+    pos = 0
+    while pos < len(data):
+        length, name, flags = struct.unpack_from(">I4sI", data, pos)
+        if name != b"data" or length < 16:
+            raise FastReadError("Unexpected atom inside tag")
+        yield flags & 0xFFFFFF, data[pos + 16 : pos + length]
+        pos += length
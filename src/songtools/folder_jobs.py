@@ -0,0 +1,110 @@
+import time
+import traceback
+
+from collections import Counter
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import click
+
+from songtools import config
+from songtools.backlog import clean_preimport_folder, load_backlog_folder_files
+from songtools.db.session import dispose_engine, get_engine
+from songtools.metrics import count, counters
+from songtools.tag_cache import close_tag_cache
+from songtools.utils import close_log_sink, echo
+
+
+@dataclass
+class FolderJobResult:
+    folder: Path
+    seconds: float = 0.0
+    error: str | None = None
+    counters: dict[str, int] = field(default_factory=dict)
+
+
+FolderJob = Callable[[Path], object]
+
+
+def clean_folder_job(folder: Path) -> None:
+    clean_preimport_folder(folder)
+
+
+def load_folder_files_job(folder: Path, remove_missing: bool = False) -> None:
+    load_backlog_folder_files(folder, get_engine(), remove_missing=remove_missing)
+
+
+def _init_worker() -> None:
+    # Connections of the parent engine must not be used in the worker
+    dispose_engine()
+    config.log_quiet = True
+
+
+def _run_job(job: FolderJob, folder: Path) -> FolderJobResult:
+    """Run the job on one folder, it runs in a worker process.
+    Errors are returned instead of raised so one broken folder doesn't stop
+    the others. Logged records and tag cache entries are written before the
+    result is returned.
+    """
+    before = Counter(counters())
+    result = FolderJobResult(folder)
+    start = time.perf_counter()
+    try:
+        job(folder)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+        echo(f"Job failed on {folder}\n{traceback.format_exc()}", "ERR")
+    finally:
+        close_tag_cache()
+        close_log_sink()
+    result.seconds = time.perf_counter() - start
+    result.counters = dict(Counter(counters()) - before)
+    return result
+
+
+def run_folder_jobs(
+    job: FolderJob, folders: list[Path], jobs: int
+) -> list[FolderJobResult]:
+    """Run the job on every folder in a pool of `jobs` processes.
+    Each worker uses its own db engine. Run metrics of the workers are merged
+    into the metrics of this process. Workers only print CHECK and ERR
+    messages, the progress is shown for the whole run.
+
+    :param job: Picklable function called with each folder
+    :param folders: Folders to run the job on
+    :param jobs: Number of worker processes
+    :return: Result of every folder, in the order they finished
+    """
+    results = []
+    with (
+        ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor,
+        click.progressbar(length=len(folders), label="Processing folders") as bar,
+    ):
+        futures = [executor.submit(_run_job, job, folder) for folder in folders]
+        for future in as_completed(futures):
+            result = future.result()
+            for name, value in result.counters.items():
+                count(name, value)
+            results.append(result)
+            bar.update(1)
+    return results
+
+
+def echo_job_summary(results: list[FolderJobResult]) -> None:
+    """Print the merged error summary.
+
+    :raises click.ClickException: If any folder failed
+    """
+    failed = [r for r in results if r.error is not None]
+    seconds = sum(r.seconds for r in results)
+    echo(
+        f"Processed {len(results)} folders, {len(failed)} failed, "
+        f"{seconds:.1f}s of work",
+        "INFO",
+    )
+    for result in sorted(failed, key=lambda r: r.folder):
+        echo(f"{result.folder}: {result.error}", "ERR")
+    if failed:
+        raise click.ClickException(f"{len(failed)} folders failed")
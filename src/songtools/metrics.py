@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import time
+
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import Engine, event
+from songtools.profiling import collect_stages, stage_timings
+
+# Counters reported by every run, also when nothing was counted
+COUNTERS = {
+    "files_walked": "Files found while walking folders",
+    "files_parsed": "Song files whose tags were parsed",
+    "parse_failures": "Song files whose tags could not be parsed",
+    "tag_cache_hits": "Song files served from the tag cache",
+    "files_hashed": "Song files whose audio content was hashed",
+    "bytes_hashed": "Bytes of audio content hashed",
+    "renames": "Renamed files",
+    "deletes": "Deleted files",
+    "folders_removed": "Removed folders",
+    "db_connections": "Database connections opened",
+    "db_statements": "Statements sent to the database",
+    "db_rows_written": "Rows inserted, updated or deleted",
+    "bytes_read": "Bytes read by the process, including db and pipes",
+}
+PROMETHEUS_PREFIX = "songtools_"
+
+_counters: Counter = Counter()
+_command = ""
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Increase a run counter, see COUNTERS for the reported ones."""
+    _counters[name] += amount
+
+
+def set_command(name: str) -> None:
+    """Name the command the report is for."""
+    global _command
+    _command = name
+
+
+def counters() -> dict[str, int]:
+    return {**{name: 0 for name in COUNTERS}, **_counters}
+
+
+def _read_bytes() -> int | None:
+    """Bytes read by the process so far, None where /proc is not available."""
+    try:
+        with open(f"/proc/{os.getpid()}/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    count("db_statements")
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    if not statement.lstrip().upper().startswith("SELECT") and cursor.rowcount > 0:
+        count("db_rows_written", cursor.rowcount)
+
+
+class MetricsReport:
+    """Counters and timings of one run, stored when the run ends.
+    Statements are counted on all engines through SQLAlchemy events.
+    Paths ending with `.prom` get the Prometheus textfile format, other paths
+    get JSON.
+    """
+
+    def __init__(self, out_path: Path) -> None:
+        self.out_path = out_path
+        self.started_at = datetime.now()
+        self.collecting = collect_stages()
+        self.start = 0.0
+        self.start_bytes: int | None = None
+
+    def __enter__(self) -> "MetricsReport":
+        _counters.clear()
+        self.collecting.__enter__()
+        self.start = time.perf_counter()
+        self.start_bytes = _read_bytes()
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.collecting.__exit__(*exc)
+        event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+        end_bytes = _read_bytes()
+        if self.start_bytes is not None and end_bytes is not None:
+            count("bytes_read", end_bytes - self.start_bytes)
+        self.store(time.perf_counter() - self.start)
+
+    def report(self, duration: float) -> dict:
+        values = counters()
+        return {
+            "command": _command,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "duration_seconds": duration,
+            "files_per_second": values["files_walked"] / duration if duration else 0,
+            "counters": values,
+            "stages": {
+                name: {"calls": timing.calls, "seconds": timing.seconds}
+                for name, timing in stage_timings().items()
+            },
+        }
+
+    def store(self, duration: float) -> None:
+        report = self.report(duration)
+        if self.out_path.suffix == ".prom":
+            content = to_prometheus(report)
+        else:
+            content = json.dumps(report, indent=2) + "\n"
+        # Replaced at once, so a collector never reads a half written file
+        tmp_path = self.out_path.with_name(self.out_path.name + ".tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, self.out_path)
+
+
+def to_prometheus(report: dict) -> str:
+    """Format the report for the node exporter textfile collector.
+    Counters are exported as gauges, they hold the values of the last run.
+    """
+    command = re.sub(r'["\\\n]', "_", report["command"])
+    labels = f'{{command="{command}"}}'
+    lines = []
+
+    def add(name: str, kind: str, help_text: str, value: float) -> None:
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}{name} {help_text}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {kind}")
+        lines.append(f"{PROMETHEUS_PREFIX}{name}{labels} {value}")
+
+    for name, value in report["counters"].items():
+        add(f"run_{name}", "gauge", COUNTERS.get(name, name), value)
+    add(
+        "run_duration_seconds",
+        "gauge",
+        "Duration of the run",
+        report["duration_seconds"],
+    )
+    add(
+        "run_files_per_second",
+        "gauge",
+        "Walked files per second",
+        report["files_per_second"],
+    )
+    if report["stages"]:
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}stage_seconds Time spent in a stage")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}stage_seconds gauge")
+    for name, timing in report["stages"].items():
+        stage_labels = f'{{command="{command}",stage="{name}"}}'
+        lines.append(
+            f"{PROMETHEUS_PREFIX}stage_seconds{stage_labels} {timing['seconds']}"
+        )
+    add(
+        "run_timestamp_seconds",
+        "gauge",
+        "Start of the run",
+        int(datetime.fromisoformat(report["started_at"]).timestamp()),
+    )
+    return "\n".join(lines) + "\n"
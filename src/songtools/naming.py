@@ -1,8 +1,50 @@
+import hashlib
 import re
 import string
 
-from functools import reduce
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Sequence
 from unidecode import unidecode
+from songtools.profiling import stage, stages_collected
+from songtools.utils import chunked
+
+# Artist names and titles repeat heavily across a library, styled names are
+# kept in a bounded cache.
+NAMING_CACHE_SIZE = 65536
+
+SPECIAL_CHARACTERS = str.maketrans(
+    {
+        "?": " ",
+        ":": " ",
+        "*": "x",
+        "\x19": " ",
+        "\x01": " ",
+        "|": " ",
+        ">": " ",
+        "<": " ",
+        "/": " ",
+        "\\": " ",
+        "_": " ",
+        ".": " ",
+    }
+)
+LOWERCASE_WORDS = (
+    (" And ", " and "),
+    (" At ", " at "),
+    (" Of ", " of "),
+    (" The ", " the "),
+    (" Is ", " is "),
+)
+ORIGINAL_MIX = re.compile(r"\(\s*original( mix)?\s*\)", re.I)
+CYRILLIC = re.compile("[\u0400-\u04ff]")
+# First character after characters: (,"[
+CAPITALIZE_AFTER = re.compile(r'[\(,"\[]\s*([a-z])')
+FEATURING_PATTERNS = (
+    (re.compile(r"(Feat(\.?)|ft\.|featuring) (.*?) -", re.I), " -"),
+    (re.compile(r"\((Feat(\.?)|ft\.) (.*?)\) ", re.I), ""),
+    (re.compile(r" \(?\[?(Feat(\.?)|ft\.) (.*?)\)?\]?$", re.I), ""),
+)
 
 
 def build_correct_song_file_name(artists: list[str], orig_title: str) -> str:
@@ -14,6 +56,15 @@ def build_correct_song_file_name(artists: list[str], orig_title: str) -> str:
 
     :return: Valid filename that can be used.
     """
+    # It runs for every file, the stage is only entered while profiling
+    if not stages_collected():
+        return _build_song_file_name(tuple(artists), orig_title)
+    with stage("naming"):
+        return _build_song_file_name(tuple(artists), orig_title)
+
+
+@lru_cache(maxsize=NAMING_CACHE_SIZE)
+def _build_song_file_name(artists: tuple[str, ...], orig_title: str) -> str:
     orig_title = basic_music_file_style(orig_title)
     title = handle_title(orig_title)
     artists = [basic_music_file_style(a) for a in artists]
@@ -23,6 +74,57 @@ def build_correct_song_file_name(artists: list[str], orig_title: str) -> str:
     return ", ".join(artists) + " - " + title
 
 
+def song_name_hash(name: str) -> str:
+    """
+    :param name: Built song name
+    :return: Case insensitive hash identifying the song
+    """
+    return hashlib.md5(name.lower().encode()).hexdigest()
+
+
+@stage("naming")
+def build_song_names(
+    songs: Iterable[tuple[Sequence[str], str]],
+    workers: int = 1,
+    chunk_size: int = 5000,
+    executor: Executor | None = None,
+) -> list[tuple[str, str]]:
+    """Build names and name hashes for a batch of songs.
+    Identical inputs are built only once, batches with more unique songs than
+    `chunk_size` can be spread across a process pool.
+
+    :param songs: Artists and title of every song
+    :param workers: Number of processes building the names
+    :param chunk_size: Number of songs sent to a worker at once
+    :param executor: Pool to use instead of starting one, for callers
+        building many batches
+    :return: Built name and name hash of every song, in the input order
+    """
+    keys = [(tuple(artists), title) for artists, title in songs]
+    unique = list(dict.fromkeys(keys))
+    if executor is not None and len(unique) > chunk_size:
+        chunks = executor.map(_build_song_names, chunked(unique, chunk_size))
+        built = [names for chunk in chunks for names in chunk]
+    elif workers > 1 and len(unique) > chunk_size:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(_build_song_names, chunked(unique, chunk_size))
+            built = [names for chunk in chunks for names in chunk]
+    else:
+        built = _build_song_names(unique)
+    by_key = dict(zip(unique, built))
+    return [by_key[key] for key in keys]
+
+
+def _build_song_names(
+    keys: list[tuple[tuple[str, ...], str]],
+) -> list[tuple[str, str]]:
+    built = []
+    for artists, title in keys:
+        name = _build_song_file_name(artists, title)
+        built.append((name, song_name_hash(name)))
+    return built
+
+
 def handle_title(title: str) -> str:
     """
     :param title: Title of the song.
@@ -63,23 +165,7 @@ def remove_special_characters(name: str) -> str:
     :param name:
     :return: string with removed special characters.
     """
-    translations = str.maketrans(
-        {
-            "?": " ",
-            ":": " ",
-            "*": "x",
-            "\x19": " ",
-            "\x01": " ",
-            "|": " ",
-            ">": " ",
-            "<": " ",
-            "/": " ",
-            "\\": " ",
-            "_": " ",
-            ".": " ",
-        }
-    )
-    return name.translate(translations).replace("( ", "(").replace(" )", ")")
+    return name.translate(SPECIAL_CHARACTERS).replace("( ", "(").replace(" )", ")")
 
 
 def remove_original_mix(name: str) -> str:
@@ -87,16 +173,17 @@ def remove_original_mix(name: str) -> str:
     :return: string with removed "original mix" suffix.
     """
 
-    return re.sub(r"\(\s*original( mix)?\s*\)", "", name, flags=re.I).strip()
+    return ORIGINAL_MIX.sub("", name).strip()
 
 
+@lru_cache(maxsize=NAMING_CACHE_SIZE)
 def basic_music_file_style(name: str) -> str:
     """
     :param name: artist or song name (works also for whole filename)
     :return: prettified name useful for file naming
     """
-    styles = [unidecode, remove_special_characters, multi_space_removal, capitalize]
-    return reduce(lambda acc, func: func(acc), styles, name)
+    name = remove_special_characters(unidecode(name))
+    return capitalize(multi_space_removal(name))
 
 
 def has_cyrillic(text: str):
@@ -105,7 +192,7 @@ def has_cyrillic(text: str):
     :param text:
     :return:
     """
-    return bool(re.search("[\u0400-\u04ff]", text))
+    return bool(CYRILLIC.search(text))
 
 
 def capitalize(name: str) -> str:
@@ -114,22 +201,12 @@ def capitalize(name: str) -> str:
     :return: correctly capitalized name
     """
     name = string.capwords(name)
+    for k, v in LOWERCASE_WORDS:
+        if k in name:
+            name = name.replace(k, v)
 
-    replacements = {
-        " And ": " and ",
-        " At ": " at ",
-        " Of ": " of ",
-        " The ": " the ",
-        " Is ": " is ",
-    }
-    for k, v in replacements.items():
-        name = name.replace(k, v)
-
-    # Capitalize first character after characters: (,"
-    name = re.sub(
-        r'[\(,"\[]\s*([a-z])',
-        lambda match: f"{match.group(0)[0]}{match.group(1).upper()}",
-        name,
+    name = CAPITALIZE_AFTER.sub(
+        lambda match: f"{match.group(0)[0]}{match.group(1).upper()}", name
     )
 
     return name
@@ -142,15 +219,10 @@ def extract_featuring_artists(title) -> (str, list[str]):
     :return: title without featuring artists and list of featuring artists
     """
     artists = []
-    patterns = [
-        (r"(Feat(\.?)|ft\.|featuring) (.*?) -", " -"),
-        (r"\((Feat(\.?)|ft\.) (.*?)\) ", ""),
-        (r" \(?\[?(Feat(\.?)|ft\.) (.*?)\)?\]?$", ""),
-    ]
-    for regex in patterns:
-        feats = re.search(regex[0], title, re.I)
+    for pattern, replacement in FEATURING_PATTERNS:
+        feats = pattern.search(title)
         if feats:
-            artists.append(re.search(regex[0], title, re.I).group(3))
-            title = title.replace(re.search(regex[0], title, re.I).group(0), regex[1])
+            artists.append(feats.group(3))
+            title = title.replace(feats.group(0), replacement)
 
     return title, artists
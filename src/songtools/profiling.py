@@ -0,0 +1,97 @@
+import cProfile
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+import click
+
+
+@dataclass
+class StageTiming:
+    calls: int = 0
+    seconds: float = 0.0
+
+
+_collecting = 0
+_timings: dict[str, StageTiming] = {}
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Measure wall-clock time of a stage while the timings are collected.
+    It works as a decorator too. Stages can nest, the time of the inner stage
+    is then included in the outer one. Time spent in worker processes is not
+    measured.
+
+    :param name: Name of the stage in the timing table
+    """
+    if not _collecting:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = _timings.setdefault(name, StageTiming())
+        timing.calls += 1
+        timing.seconds += time.perf_counter() - start
+
+
+def stages_collected() -> bool:
+    """Cheap check for hot loops that would rather skip :func:`stage`."""
+    return _collecting > 0
+
+
+def stage_timings() -> dict[str, StageTiming]:
+    return dict(_timings)
+
+
+@contextmanager
+def collect_stages() -> Iterator[None]:
+    """Collect stage timings, the timings are reset when nothing else
+    is collecting them already.
+    """
+    global _collecting
+    if not _collecting:
+        _timings.clear()
+    _collecting += 1
+    try:
+        yield
+    finally:
+        _collecting -= 1
+
+
+class Profiler:
+    """cProfile of the whole run with the per-stage timings."""
+
+    def __init__(self, out_path: Path) -> None:
+        self.out_path = out_path
+        self.profile = cProfile.Profile()
+        self.collecting = collect_stages()
+        self.start = 0.0
+
+    def __enter__(self) -> "Profiler":
+        self.collecting.__enter__()
+        self.start = time.perf_counter()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.profile.disable()
+        self.collecting.__exit__(*exc)
+        self.profile.dump_stats(self.out_path)
+        self.print_report(time.perf_counter() - self.start)
+
+    def print_report(self, total: float) -> None:
+        click.echo(f"\n{'stage':<32}{'calls':>10}{'seconds':>12}{'share':>8}")
+        timings = sorted(_timings.items(), key=lambda t: t[1].seconds, reverse=True)
+        for name, timing in timings:
+            share = timing.seconds / total if total else 0
+            click.echo(
+                f"{name:<32}{timing.calls:>10}{timing.seconds:>12.3f}{share:>8.1%}"
+            )
+        click.echo(f"{'total':<32}{'':>10}{total:>12.3f}")
+        click.echo(f"Profile stored in {self.out_path}")
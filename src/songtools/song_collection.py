@@ -1,18 +1,20 @@
 import click
+from dataclasses import dataclass
 from pathlib import Path
 
 from sqlalchemy.orm import Session
-from sqlalchemy import select, delete, Engine
-from copy import deepcopy
+from sqlalchemy import select, delete, insert, update, or_, true, Engine
 
 from songtools import config
+from songtools.metrics import count
+from songtools.profiling import stage
+from songtools.content_hash import cached_content_hash
+from songtools.collection_snapshot import SnapshotRecord, scan_collection
 from songtools.db.models import HeardSong, CollectionSong
-from songtools.naming import build_correct_song_file_name
-from songtools.song_file_types import (
-    SUPPORTED_MUSIC_TYPES,
-    SongFile,
-    UnableToExtractData,
-)
+from songtools.utils import chunked, echo
+from songtools.song_file_types import SUPPORTED_MUSIC_TYPES, SongFile
+
+DB_CHUNK_SIZE = 5000
 
 
 def show_collection_name_inconsistencies():
@@ -25,85 +27,162 @@ def show_collection_name_inconsistencies():
 
 def list_collection_songs_paths() -> list[Path]:
     collection_path = Path(config.collection_path)
-    return [
-        f
-        for f in collection_path.rglob("*")
-        if f.is_file() and f.suffix in SUPPORTED_MUSIC_TYPES
-    ]
+    files = [f for f in collection_path.rglob("*") if f.is_file()]
+    count("files_walked", len(files))
+    return [f for f in files if f.suffix in SUPPORTED_MUSIC_TYPES]
+
+
+@stage("scan_collection_songs")
+def scan_collection_songs() -> list[SnapshotRecord]:
+    """Scan the collection, reusing the snapshot of the previous scan."""
+    snapshot_path = config.collection_snapshot_path
+    return scan_collection(
+        list_collection_songs_paths(), Path(snapshot_path) if snapshot_path else None
+    )
 
 
-def get_collection_items():
-    res = {}
-    for x in list_collection_songs_paths():
-        song = SongFile(x)
-        res[song.name_hash] = song
+def get_collection_items() -> dict[str, SnapshotRecord]:
+    return {record.name_hash: record for record in scan_collection_songs()}
 
-    return res
+
+@stage("get_collection_content_hashes")
+def get_collection_content_hashes() -> dict[str, Path]:
+    """Hash the audio content of all collection songs.
+    Hashes are kept in the tag cache, only changed songs are read again.
+
+    :return: Song paths by content hash
+    """
+    hashes = {}
+    for path in list_collection_songs_paths():
+        content_hash = cached_content_hash(path)
+        if content_hash is not None:
+            hashes[content_hash] = path
+    return hashes
 
 
 def get_incorrectly_formatted_collection_names() -> list[(Path, str)]:
-    res = []
-    for f in list_collection_songs_paths():
-        try:
-            song = SongFile(f)
-            built_name = build_correct_song_file_name(song.artists, song.title)
-            if built_name != f.stem:
-                res.append((f, built_name))
-        except UnableToExtractData:
-            click.secho(f"Could not extract data from {f}", fg="red")
-
-    return res
-
-
-def recreate_collection_records(
-    collection_songs: dict[str, SongFile], db_engine: Engine
-):
-    with Session(db_engine) as session:
-        session.execute(delete(CollectionSong))
-        session.commit()
+    return [
+        (record.path, record.built_name)
+        for record in scan_collection_songs()
+        if record.built_name != record.path.stem
+    ]
+
 
-        for song_hash, song in collection_songs.items():
-            db_song = CollectionSong(
-                name_hash=song.name_hash,
-                file_path=song.path.name,
-                file_size=song.file_size_kb,
+@dataclass
+class CollectionChanges:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+
+
+@stage("refresh_collection_records")
+def refresh_collection_records(
+    collection_songs: dict[str, SnapshotRecord | SongFile], db_engine: Engine
+) -> CollectionChanges:
+    """Make song_collection match the scanned collection.
+    Only rows that changed are inserted, updated or deleted, all in one
+    transaction so the table is never empty halfway through.
+
+    :param collection_songs: Scanned collection songs by name hash
+    :param Engine db_engine: Database engine
+    :return: Number of inserted, updated and deleted rows
+    """
+    scanned = {
+        song_hash: (song.path.name, song.file_size_kb)
+        for song_hash, song in collection_songs.items()
+    }
+    changes = CollectionChanges()
+    with Session(db_engine) as session:
+        existing = {
+            name_hash: (file_path, file_size)
+            for name_hash, file_path, file_size in session.execute(
+                select(
+                    CollectionSong.name_hash,
+                    CollectionSong.file_path,
+                    CollectionSong.file_size,
+                )
+            )
+        }
+        new_rows = []
+        changed_rows = []
+        for name_hash, (file_path, file_size) in scanned.items():
+            row = {
+                "name_hash": name_hash,
+                "file_path": file_path,
+                "file_size": file_size,
+            }
+            if name_hash not in existing:
+                new_rows.append(row)
+            elif existing[name_hash] != (file_path, file_size):
+                changed_rows.append(row)
+        removed = [name_hash for name_hash in existing if name_hash not in scanned]
+
+        if new_rows:
+            session.execute(insert(CollectionSong), new_rows)
+        if changed_rows:
+            session.execute(update(CollectionSong), changed_rows)
+        for chunk in chunked(removed, DB_CHUNK_SIZE):
+            session.execute(
+                delete(CollectionSong).where(CollectionSong.name_hash.in_(chunk))
             )
-            session.add(db_song)
         session.commit()
 
-
-def sync_collection_with_heard_songs(
-    collection_songs: dict[str, SongFile], db_engine: Engine
-):
-    # TODO: sync to heard table insert / update
-    # TODO: remove non-existing files from heard collection.
-    collection_songs = deepcopy(collection_songs)
+    changes.inserted = len(new_rows)
+    changes.updated = len(changed_rows)
+    changes.deleted = len(removed)
+    echo(
+        f"Collection records: {changes.inserted} inserted, "
+        f"{changes.updated} updated, {changes.deleted} deleted",
+        "INFO",
+    )
+    return changes
+
+
+@stage("sync_collection_with_heard_songs")
+def sync_collection_with_heard_songs(db_engine: Engine):
+    """Reconcile songs_heard with song_collection in set-based statements.
+    song_collection has to be refreshed from the collection folder first,
+    it holds the set of name hashes the heard songs are compared with.
+
+    :param Engine db_engine: Database engine
+    """
+    collection_hashes = select(CollectionSong.name_hash)
+    heard_hashes = select(HeardSong.name_hash)
     with Session(db_engine) as session:
-        stm = select(HeardSong).where(HeardSong.in_collection == True)  # noqa
-        for song in session.scalars(stm).all():
-            if song.name_hash not in collection_songs:
-                song.in_collection = False
-                session.commit()
-            else:
-                del collection_songs[song.name_hash]
-
-        for song_hash, song in collection_songs.items():
-            item = session.scalars(
-                select(HeardSong).where(HeardSong.name_hash == song.name_hash)
-            ).first()
-            if not item:
-                item = HeardSong(
-                    name_hash=song.name_hash,
-                    file_name=song.path.name,
-                    in_collection=True,
-                )
-                session.add(item)
-            else:
-                item.in_collection = True
+        session.execute(
+            update(HeardSong)
+            .where(
+                HeardSong.in_collection == True,  # noqa: E712
+                HeardSong.name_hash.not_in(collection_hashes),
+            )
+            .values(in_collection=False)
+            .execution_options(synchronize_session=False)
+        )
+        session.execute(
+            update(HeardSong)
+            .where(
+                or_(
+                    HeardSong.in_collection == False,  # noqa: E712
+                    HeardSong.in_collection == None,  # noqa: E711
+                ),
+                HeardSong.name_hash.in_(collection_hashes),
+            )
+            .values(in_collection=True)
+            .execution_options(synchronize_session=False)
+        )
+        session.execute(
+            insert(HeardSong).from_select(
+                ["name_hash", "file_name", "in_collection"],
+                select(
+                    CollectionSong.name_hash, CollectionSong.file_path, true()
+                ).where(CollectionSong.name_hash.not_in(heard_hashes)),
+            )
+        )
         session.commit()
 
 
+@stage("sync_collection_items")
 def sync_collection_items(db_engine: Engine):
     collection_items = get_collection_items()
-    recreate_collection_records(collection_items, db_engine)
-    sync_collection_with_heard_songs(collection_items, db_engine)
+    refresh_collection_records(collection_items, db_engine)
+    sync_collection_with_heard_songs(db_engine)
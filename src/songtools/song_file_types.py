@@ -1,13 +1,18 @@
-import hashlib
-
 import click
 import mutagen
 import math
+import sqlite3
 
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import Callable
 from songtools import config as config
-from songtools.naming import build_correct_song_file_name
+from songtools.content_hash import cached_content_hash
+from songtools.fast_tags import FastTags, read_flac, read_id3, read_mp4
+from songtools.naming import build_correct_song_file_name, song_name_hash
+from songtools.metrics import count
+from songtools.profiling import stage
+from songtools.tag_cache import get_tag_cache
 
 SUPPORTED_MUSIC_TYPES = [".mp3", ".flac", ".wav", ".m4a", ".mp4"]
 
@@ -21,8 +26,15 @@ class UnableToExtractData(Exception):
 
 
 class MetaRetriever(ABC):
+    # Header-only reader used when config.tag_reader is "fast"
+    fast_reader: Callable[[Path], FastTags | None] | None = None
+
     def __init__(self, path: Path) -> None:
-        self.metadata = mutagen.File(path)
+        self.metadata = None
+        if config.tag_reader == "fast" and self.fast_reader:
+            self.metadata = self.fast_reader(path)
+        if self.metadata is None:
+            self.metadata = mutagen.File(path)
         if self.metadata is None:
             raise UnableToExtractData()
 
@@ -59,20 +71,162 @@ class MetaRetriever(ABC):
         return math.ceil(self.metadata.info.length)
 
 
+class StaticMetaRetriever(MetaRetriever):
+    """Metadata that was already extracted into plain values."""
+
+    FIELDS = (
+        "artists",
+        "title",
+        "bpm",
+        "year",
+        "key",
+        "energy",
+        "genre",
+        "duration_seconds",
+    )
+
+    def __init__(self, values: dict) -> None:
+        self.metadata = None
+        self.values = values
+
+    @classmethod
+    def from_retriever(cls, retriever: MetaRetriever) -> "StaticMetaRetriever":
+        return cls({field: getattr(retriever, field) for field in cls.FIELDS})
+
+    @property
+    def artists(self) -> str:
+        return self.values["artists"]
+
+    @property
+    def title(self) -> str:
+        return self.values["title"]
+
+    @property
+    def bpm(self) -> float:
+        return self.values["bpm"]
+
+    @property
+    def year(self) -> int:
+        return self.values["year"]
+
+    @property
+    def key(self) -> str:
+        return self.values["key"]
+
+    @property
+    def energy(self) -> int:
+        return self.values["energy"]
+
+    @property
+    def genre(self) -> str:
+        return self.values["genre"]
+
+    @property
+    def duration_seconds(self) -> int:
+        return self.values["duration_seconds"]
+
+
+class memoized:
+    """Read-only property computed once and stored in the `_<name>` slot."""
+
+    def __init__(self, func) -> None:
+        self.func = func
+        self.slot = "_" + func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.func(obj)
+            setattr(obj, self.slot, value)
+            return value
+
+
 class SongFile:
+    __slots__ = (
+        "path",
+        "metadata",
+        "size",
+        "_artists",
+        "_title",
+        "_duration_seconds",
+        "_file_size_kb",
+        "_bpm",
+        "_genre",
+        "_year",
+        "_key",
+        "_energy",
+        "_name_hash",
+        "_content_hash",
+    )
+
     def __init__(self, path: Path):
-        if not path.exists():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
             raise FileNotFoundError(f"Song File {path} does not exist.")
 
         self.path: Path = path
+        self.size: int = stat.st_size
         self.metadata: MetaRetriever | None = None
-        try:
-            self.metadata: MetaRetriever = self._load_metadata()
-        except (mutagen.MutagenError, UnableToExtractData) as e:
-            click.secho(f"Could not read metadata from file {path}.", fg="yellow")
-            click.secho(e, fg="yellow", bg="white")
+
+        cache = get_tag_cache()
+        cached = None
+        if cache is not None:
+            try:
+                with stage("tag cache"):
+                    cached = cache.get(path, stat)
+            except sqlite3.OperationalError:
+                # A locked cache is a miss, the file is parsed instead
+                count("tag_cache_errors")
+        if cached:
+            count("tag_cache_hits")
+            self.metadata = StaticMetaRetriever(cached.fields)
+            if cached.name_hash:
+                self._name_hash = cached.name_hash
+            if cached.content_hash:
+                self._content_hash = cached.content_hash
+        else:
+            count("files_parsed")
+            try:
+                with stage("parse tags"):
+                    self.metadata: MetaRetriever = self._load_metadata()
+            except (mutagen.MutagenError, UnableToExtractData) as e:
+                count("parse_failures")
+                click.secho(f"Could not read metadata from file {path}.", fg="yellow")
+                click.secho(e, fg="yellow", bg="white")
         self._check_naming()
 
+        if not cached:
+            with stage("parse tags"):
+                released = self.release_metadata()
+            if released and self.metadata and cache is not None:
+                name_hash = self.name_hash
+                try:
+                    with stage("tag cache"):
+                        cache.put(self.path, stat, self.metadata.values, name_hash)
+                except sqlite3.OperationalError:
+                    count("tag_cache_errors")
+
+    def release_metadata(self) -> bool:
+        """Replace the mutagen object with the plain extracted values,
+        so the parsed file doesn't stay in memory.
+        Files with fields that can't be extracted keep the mutagen object and
+        are not cached, those fields keep being read from it.
+
+        :return: True if the metadata holds only plain values now
+        """
+        if self.metadata is None or isinstance(self.metadata, StaticMetaRetriever):
+            return True
+        try:
+            self.metadata = StaticMetaRetriever.from_retriever(self.metadata)
+        except Exception:
+            return False
+        return True
+
     def _check_naming(self):
         if self.path.stem.count("-") != 1 and (
             not self.metadata or not (self.metadata.artists or self.metadata.title)
@@ -92,7 +246,7 @@ class SongFile:
         else:
             raise UnsupportedSongType(f"Song File {self.path} is not supported.")
 
-    @property
+    @memoized
     def artists(self) -> list[str]:
         """Retrieve artists from metadata, or filename if metadata is not present.
 
@@ -108,7 +262,7 @@ class SongFile:
             artists = self._get_artists_from_filename()
         return [a.strip() for a in artists.split(", ")]
 
-    @property
+    @memoized
     def duration_seconds(self) -> int:
         """
         :return: Duration of the song in seconds
@@ -122,7 +276,7 @@ class SongFile:
             return 0
         return self.metadata.duration_seconds
 
-    @property
+    @memoized
     def title(self) -> str:
         if self.metadata and self.metadata.title:
             title = self.metadata.title
@@ -134,17 +288,17 @@ class SongFile:
 
         return title.strip()
 
-    @property
+    @memoized
     def file_size_kb(self) -> int:
-        return math.ceil(self.path.stat().st_size / 1024)
+        return math.ceil(self.size / 1024)
 
-    @property
+    @memoized
     def bpm(self) -> float:
         if not self.metadata:
             return 0.0
         return self.metadata.bpm
 
-    @property
+    @memoized
     def genre(self) -> str:
         if not self.metadata:
             return (
@@ -154,28 +308,34 @@ class SongFile:
             )
         return self.metadata.genre
 
-    @property
+    @memoized
     def year(self) -> int:
         if not self.metadata:
             return 0
         return self.metadata.year
 
-    @property
+    @memoized
     def key(self) -> str:
         if not self.metadata:
             return ""
         return self.metadata.key
 
-    @property
+    @memoized
     def energy(self) -> int:
         if not self.metadata:
             return 0
         return self.metadata.energy
 
-    @property
+    @memoized
     def name_hash(self):
-        name = build_correct_song_file_name(self.artists, self.title)
-        return hashlib.md5(name.lower().encode()).hexdigest()
+        return song_name_hash(build_correct_song_file_name(self.artists, self.title))
+
+    @memoized
+    def content_hash(self) -> str | None:
+        """Hash of the audio payload, it is the same for differently tagged
+        copies of the same audio. The whole file is read the first time.
+        """
+        return cached_content_hash(self.path)
 
     def _get_artists_from_filename(self) -> str:
         """Fallback method to extract artists from filename."""
@@ -187,6 +347,8 @@ class SongFile:
 
 
 class ID3File(MetaRetriever):
+    fast_reader = staticmethod(read_id3)
+
     @property
     def artists(self) -> str:
         return self._get_tag("TPE1")
@@ -234,6 +396,8 @@ class ID3File(MetaRetriever):
 
 
 class FlacFile(MetaRetriever):
+    fast_reader = staticmethod(read_flac)
+
     @property
     def artists(self) -> str:
         return ", ".join(self.metadata.get("artist", [""]))
@@ -280,6 +444,8 @@ class FlacFile(MetaRetriever):
 
 
 class M4AFile(MetaRetriever):
+    fast_reader = staticmethod(read_mp4)
+
     @property
     def artists(self) -> str:
         return self._get_tag("©ART")
@@ -0,0 +1,279 @@
+import atexit
+import json
+import os
+import sqlite3
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from songtools import config
+
+# Bump when the stored fields or the naming rules behind name_hash change,
+# older caches are then dropped and rebuilt.
+CACHE_VERSION = 3
+
+
+@dataclass
+class CachedTags:
+    fields: dict
+    name_hash: str | None
+    content_hash: str | None = None
+
+
+class TagCache:
+    """On-disk cache of extracted song metadata.
+    Entries are keyed by the absolute path, size and mtime of the file, so any
+    change of the file invalidates its entry. When the cache grows over
+    `max_entries`, the least recently used entries are evicted. Hits only
+    note the time of use, it is written with the next commit in one batch.
+    Every write is committed right away, so the write lock of the file is
+    only held for a moment and several processes can share the cache.
+    """
+
+    def __init__(
+        self, path: Path, max_entries: int = 500_000, commit_every: int = 1000
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending = 0
+        self._closed = False
+        self._entries: int | None = None
+        self._used: dict[str, int] = {}
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._prepare_schema()
+
+    def _prepare_schema(self) -> None:
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS tags")
+            self.connection.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS tags (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                fields TEXT,
+                name_hash TEXT,
+                content_hash TEXT,
+                last_used INTEGER NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tags_last_used ON tags (last_used)"
+        )
+        self.connection.commit()
+
+    def get(self, path: Path, stat: os.stat_result) -> CachedTags | None:
+        """
+        :param Path path: Path to the song file
+        :param stat: Current stat of the file
+        :return: Cached tags, None if the file is not cached or changed since
+        """
+        key = str(path.absolute())
+        row = self.connection.execute(
+            "SELECT fields, name_hash, content_hash FROM tags "
+            "WHERE path = ? AND size = ? AND mtime_ns = ? AND fields IS NOT NULL",
+            (key, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._used[key] = time.time_ns()
+        self._written()
+        return CachedTags(
+            fields=json.loads(row[0]), name_hash=row[1], content_hash=row[2]
+        )
+
+    def put(
+        self, path: Path, stat: os.stat_result, fields: dict, name_hash: str | None
+    ) -> None:
+        """Store extracted tags of a file, replacing any older entry.
+        A content hash of the same file version is kept.
+
+        :param Path path: Path to the song file
+        :param stat: Stat of the file the tags were extracted from
+        :param fields: Extracted metadata fields
+        :param name_hash: Name hash of the song
+        """
+        self._upsert(
+            path,
+            stat,
+            {"fields": json.dumps(fields), "name_hash": name_hash},
+            kept=["content_hash"],
+        )
+
+    def get_content_hash(self, path: Path, stat: os.stat_result) -> str | None:
+        """
+        :param Path path: Path to the song file
+        :param stat: Current stat of the file
+        :return: Cached content hash, None if it is not cached or the file changed
+        """
+        key = str(path.absolute())
+        row = self.connection.execute(
+            "SELECT content_hash FROM tags "
+            "WHERE path = ? AND size = ? AND mtime_ns = ? "
+            "AND content_hash IS NOT NULL",
+            (key, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row is None:
+            return None
+        self._used[key] = time.time_ns()
+        self._written()
+        return row[0]
+
+    def put_content_hash(
+        self, path: Path, stat: os.stat_result, content_hash: str
+    ) -> None:
+        """Store the content hash of a file, files without cached tags get
+        an entry with the hash only. Tags of the same file version are kept.
+
+        :param Path path: Path to the song file
+        :param stat: Stat of the file the hash was computed from
+        :param content_hash: Hash of the audio payload
+        """
+        self._upsert(
+            path, stat, {"content_hash": content_hash}, kept=["fields", "name_hash"]
+        )
+
+    def _upsert(
+        self, path: Path, stat: os.stat_result, values: dict, kept: list[str]
+    ) -> None:
+        """Insert or update the entry of a file with `values`.
+        Columns in `kept` stay when the entry is for the same size and mtime,
+        they are cleared for any other version of the file.
+        """
+        columns = ["path", "size", "mtime_ns", "last_used", *values]
+        same_version = "tags.size = excluded.size AND tags.mtime_ns = excluded.mtime_ns"
+        updates = [f"{c} = excluded.{c}" for c in columns[1:]] + [
+            f"{c} = CASE WHEN {same_version} THEN tags.{c} END" for c in kept
+        ]
+        try:
+            self.connection.execute(
+                f"INSERT INTO tags ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (path) DO UPDATE SET {', '.join(updates)}",
+                (
+                    str(path.absolute()),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    time.time_ns(),
+                    *values.values(),
+                ),
+            )
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+            raise
+        if self._entries is not None:
+            self._entries += 1
+        self._written()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM tags").fetchone()[0]
+
+    def evict(self) -> int:
+        """Remove the least recently used entries if the cache is over its size.
+        It evicts down to 90% of `max_entries` so it doesn't run on every insert.
+
+        :return: Number of evicted entries
+        """
+        self._store_used()
+        self._entries = len(self)
+        if self._entries <= self.max_entries:
+            return 0
+        evicted = self._entries - int(self.max_entries * 0.9)
+        self.connection.execute(
+            "DELETE FROM tags WHERE path IN "
+            "(SELECT path FROM tags ORDER BY last_used LIMIT ?)",
+            (evicted,),
+        )
+        self.connection.commit()
+        self._entries -= evicted
+        self.evictions += evicted
+        return evicted
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def commit(self) -> None:
+        self._store_used()
+        self.connection.commit()
+        self._pending = 0
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.commit()
+            self.evict()
+        finally:
+            self.connection.close()
+
+    def _store_used(self) -> None:
+        if self._used:
+            used = [(used, key) for key, used in self._used.items()]
+            self._used.clear()
+            try:
+                self.connection.executemany(
+                    "UPDATE tags SET last_used = ? WHERE path = ?", used
+                )
+                self.connection.commit()
+            except sqlite3.Error:
+                self.connection.rollback()
+                raise
+
+    def _written(self) -> None:
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+            if self._entries is None or self._entries > self.max_entries:
+                self.evict()
+
+
+_tag_cache: TagCache | None = None
+_tag_cache_pid: int | None = None
+# Caches of the parent process, kept so forked workers never close them
+_inherited_tag_caches: list[TagCache] = []
+
+
+def get_tag_cache() -> TagCache | None:
+    """Return the process-wide tag cache, None if it is disabled.
+    Every process opens its own connection, sqlite connections can't be shared
+    with forked workers.
+    """
+    global _tag_cache, _tag_cache_pid
+    if not config.tag_cache_path:
+        return None
+    if _tag_cache is None or _tag_cache_pid != os.getpid():
+        if _tag_cache is not None:
+            _inherited_tag_caches.append(_tag_cache)
+        _tag_cache = TagCache(
+            Path(config.tag_cache_path), max_entries=config.tag_cache_max_entries
+        )
+        _tag_cache_pid = os.getpid()
+        atexit.register(_tag_cache.close)
+    return _tag_cache
+
+
+def close_tag_cache() -> None:
+    """Write the pending state of the tag cache of the process and close it,
+    the next use opens it again. Worker processes of a pool don't run atexit
+    handlers, they have to call it after each job.
+    """
+    global _tag_cache, _tag_cache_pid
+    if _tag_cache is not None and _tag_cache_pid == os.getpid():
+        _tag_cache.close()
+    elif _tag_cache is not None:
+        _inherited_tag_caches.append(_tag_cache)
+    _tag_cache = None
+    _tag_cache_pid = None
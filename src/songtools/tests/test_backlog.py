@@ -1,3 +1,6 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from unittest.mock import patch
 
 import pytest
@@ -8,20 +11,31 @@ from songtools.conftest import (
     MetadataFields,
 )
 from pathlib import Path
-from sqlalchemy import asc
+from sqlalchemy import asc, event, select
 from sqlalchemy.orm import Session
 from songtools.backlog import (
+    apply_file_rules,
+    BacklogSyncStats,
     clean_preimport_folder,
+    CLEANING_RULES,
     IRRELEVANT_SUFFIXES,
     load_backlog_folder_files,
     load_backlog_folder_metadata,
     delete_song_folder,
     InsecureDeleteException,
     dedup_song_folder,
+    dedup_song_folder_by_content,
+    PruneStats,
+    rehash_backlog_songs,
+    remove_empty_folders,
 )
+from songtools import config
+from songtools.content_hash import audio_content_hash
+from songtools.naming import build_correct_song_file_name, song_name_hash
 from songtools.db.models import BacklogSong, HeardSong, CollectionSong
 from songtools.db.session import get_in_memory_engine
 from songtools.song_file_types import SongFile
+from songtools.tag_cache import close_tag_cache, TagCache
 
 
 def _prepare_dirty_backlog_folder(root_folder: Path) -> Path:
@@ -81,6 +95,22 @@ def test_remove_folders_with_metadata_only(test_folder):
     assert not (tst_folder / "metadata_only_folder").exists()
 
 
+def test_nested_empty_folders_are_pruned_in_one_pass(test_folder):
+    deepest = test_folder / "a/b/c/d"
+    deepest.mkdir(parents=True)
+    (deepest / "desktop.ini").touch()
+    (test_folder / "a/b/.DS_Store").touch()
+    kept = test_folder / "keep"
+    kept.mkdir()
+    make_simple_song_file(kept, "Song uno")
+
+    stats = remove_empty_folders(test_folder)
+
+    assert stats == PruneStats(visited=5, removed=4)
+    assert not (test_folder / "a").exists()
+    assert kept.exists()
+
+
 def test_remove_irrelevant_files(test_folder):
     tst_folder = _prepare_dirty_backlog_folder(test_folder)
     clean_preimport_folder(tst_folder)
@@ -126,6 +156,18 @@ def test_uppercase_suffixes_get_lowered(test_folder):
     assert (tst_folder / "mixed_folder/Onetwo - Threefour.mp3").exists()
 
 
+def test_rules_are_applied_in_order_on_a_single_walk(test_folder):
+    tst_folder = _prepare_dirty_backlog_folder(test_folder)
+    screaming_rubbish = tst_folder / "mixed_folder/cover.JPG"
+    screaming_rubbish.touch()
+    with patch("songtools.backlog.os.walk", wraps=os.walk) as walk:
+        apply_file_rules(tst_folder, CLEANING_RULES)
+    assert walk.call_count == 1
+    assert not screaming_rubbish.exists()
+    assert not (tst_folder / "mixed_folder/cover.jpg").exists()
+    assert (tst_folder / "mixed_folder/Onetwo - Threefour.mp3").exists()
+
+
 def test_songs_in_backlog_are_loaded_into_db(test_folder):
     engine = get_in_memory_engine()
     BacklogSong.metadata.create_all(engine)
@@ -140,6 +182,101 @@ def test_songs_in_backlog_are_loaded_into_db(test_folder):
     assert songs == num_entries
 
 
+def test_reloading_backlog_only_adds_new_and_removes_missing_songs(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    sub_folder = test_folder / "sub"
+    sub_folder.mkdir()
+    for i in range(4):
+        (sub_folder / f"song_{i}.mp3").touch()
+    (test_folder / "song_root.mp3").touch()
+    load_backlog_folder_files(test_folder, engine)
+
+    (sub_folder / "song_0.mp3").unlink()
+    (sub_folder / "song_new.mp3").touch()
+    stats = load_backlog_folder_files(sub_folder, engine, remove_missing=True)
+
+    assert stats == BacklogSyncStats(found=4, inserted=1, removed=1)
+    session = Session(engine)
+    paths = session.scalars(select(BacklogSong.path).order_by(BacklogSong.path))
+    assert list(paths) == [
+        "song_root.mp3",
+        "sub/song_1.mp3",
+        "sub/song_2.mp3",
+        "sub/song_3.mp3",
+        "sub/song_new.mp3",
+    ]
+
+
+def test_backlog_songs_are_rehashed_from_stored_metadata(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    song = make_simple_song_file(test_folder, "Song uno", "JdPouch, Hugo")
+    load_backlog_folder_files(test_folder, engine)
+    load_backlog_folder_metadata(engine)
+    with Session(engine) as session:
+        session.add(BacklogSong(path="missing.mp3", artists="Hugo", title="Song"))
+        session.commit()
+
+    with patch("songtools.backlog.SongFile") as song_file:
+        assert rehash_backlog_songs(engine, store_after=1) == 1
+        song_file.assert_not_called()
+    assert rehash_backlog_songs(engine) == 0
+
+    session = Session(engine)
+    hashes = dict(
+        session.execute(select(BacklogSong.path, BacklogSong.name_hash)).all()
+    )
+    assert hashes[song.name] == SongFile(song).name_hash
+    assert hashes["missing.mp3"] is not None
+
+
+def test_rehash_strips_stored_artists(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(BacklogSong(path="song.mp3", artists="JdP, Hugo ", title="Song"))
+        session.commit()
+
+    with patch("songtools.backlog.build_song_names", return_value=[]) as build:
+        rehash_backlog_songs(engine)
+
+    assert list(build.call_args.args[0]) == [(["JdP", "Hugo"], "Song")]
+
+
+def test_backlog_songs_are_rehashed_in_one_worker_pool(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            BacklogSong(path=f"song_{i}.mp3", artists="JdP", title=f"Song {i}")
+            for i in range(6)
+        )
+        session.commit()
+    pools = []
+
+    class TrackedPool(ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.maps = 0
+            pools.append(self)
+
+        def map(self, *args, **kwargs):
+            self.maps += 1
+            return super().map(*args, **kwargs)
+
+    with patch("songtools.backlog.ProcessPoolExecutor", TrackedPool):
+        assert rehash_backlog_songs(engine, workers=2, store_after=3) == 6
+
+    assert [pool.maps for pool in pools] == [2]
+    with Session(engine) as session:
+        hashes = session.scalars(select(BacklogSong.name_hash)).all()
+    assert sorted(hashes) == sorted(
+        song_name_hash(build_correct_song_file_name(["JdP"], f"Song {i}"))
+        for i in range(6)
+    )
+
+
 def test_songs_from_the_db_get_metadata_loaded(test_folder):
     engine = get_in_memory_engine()
     BacklogSong.metadata.create_all(engine)
@@ -159,6 +296,67 @@ def test_songs_from_the_db_get_metadata_loaded(test_folder):
     assert songs[0].title == mf.title
 
 
+def test_metadata_is_loaded_by_worker_processes_in_batches(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+
+    for i in range(5):
+        make_simple_song_file(test_folder, f"Song {i}", "JdPouch")
+    (test_folder / "broken.mp3").touch()
+
+    load_backlog_folder_files(test_folder, engine)
+    load_backlog_folder_metadata(engine, workers=2, store_after=2)
+
+    session = Session(engine)
+    songs = {s.path: s for s in session.query(BacklogSong).all()}
+    assert len(songs) == 6
+    assert songs.pop("broken.mp3").title is None
+    assert sorted(s.title for s in songs.values()) == [f"Song {i}" for i in range(5)]
+    assert all(s.artists == "JdPouch" for s in songs.values())
+
+
+def test_workers_share_the_tag_cache(test_folder, tmp_path, monkeypatch):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    for i in range(8):
+        make_simple_song_file(test_folder, f"Song {i}", "JdPouch")
+    load_backlog_folder_files(test_folder, engine)
+    monkeypatch.setattr(config, "tag_cache_path", str(tmp_path / "tags.sqlite"))
+
+    start = time.perf_counter()
+    load_backlog_folder_metadata(engine, workers=2, store_after=4)
+    close_tag_cache()
+
+    assert time.perf_counter() - start < 10
+    with Session(engine) as session:
+        titles = session.scalars(select(BacklogSong.title)).all()
+    assert sorted(titles) == [f"Song {i}" for i in range(8)]
+    assert len(TagCache(tmp_path / "tags.sqlite")) == 8
+
+
+def test_metadata_loading_resumes_after_the_last_processed_path(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    for i in range(5):
+        make_simple_song_file(test_folder, "Song", "JdPouch", filename=f"s{i}.mp3")
+    load_backlog_folder_files(test_folder, engine)
+
+    with patch("songtools.backlog.click.progressbar") as progressbar:
+        last_path = load_backlog_folder_metadata(
+            engine, store_after=2, resume_after="s1.mp3"
+        )
+        progressbar.assert_called_once_with(
+            length=3, label="Loading metadata for songs"
+        )
+
+    assert last_path == "s4.mp3"
+    session = Session(engine)
+    loaded = session.scalars(
+        select(BacklogSong.path).where(BacklogSong.title.is_not(None))
+    )
+    assert sorted(loaded) == ["s2.mp3", "s3.mp3", "s4.mp3"]
+
+
 def test_delete_removes_files_and_subfolders(test_folder):
     engine = get_in_memory_engine()
     HeardSong.metadata.create_all(engine)
@@ -208,6 +406,35 @@ def test_unknown_file_raises_exception(test_folder):
         delete_song_folder(test_folder, get_in_memory_engine())
 
 
+def test_unknown_file_deep_in_tree_stops_delete_before_any_change(test_folder):
+    engine = get_in_memory_engine()
+    HeardSong.metadata.create_all(engine)
+    song = make_simple_song_file(test_folder, "Song uno")
+    deep_folder = test_folder / "a/b/c"
+    deep_folder.mkdir(parents=True)
+    (deep_folder / "unknown_file.ggwp").touch()
+
+    with pytest.raises(InsecureDeleteException):
+        delete_song_folder(test_folder, engine)
+
+    assert song.exists()
+    assert Session(engine).query(HeardSong).count() == 0
+
+
+def test_keep_folder_removes_only_the_content(test_folder):
+    engine = get_in_memory_engine()
+    HeardSong.metadata.create_all(engine)
+    sub_folder = test_folder / "sub"
+    sub_folder.mkdir()
+    make_simple_song_file(sub_folder, "Song uno")
+    (sub_folder / "cover.jpg").touch()
+
+    delete_song_folder(test_folder, engine, keep_folder=True)
+
+    assert test_folder.exists()
+    assert not any(test_folder.iterdir())
+
+
 def test_dedup_removes_duplicates_also_in_subfolders(test_folder):
     engine = get_in_memory_engine()
     HeardSong.metadata.create_all(engine)
@@ -243,6 +470,90 @@ def test_dedup_removes_duplicates_also_in_subfolders(test_folder):
     assert not song_6.exists()
 
 
+def test_dedup_resolves_heard_songs_in_chunked_queries(test_folder):
+    engine = get_in_memory_engine()
+    HeardSong.metadata.create_all(engine)
+    songs = [make_simple_song_file(test_folder, f"Song {i}") for i in range(5)]
+    with Session(engine) as s:
+        s.add_all(
+            [
+                HeardSong(file_name=song.name, name_hash=SongFile(song).name_hash)
+                for song in songs[:3]
+            ]
+        )
+        s.commit()
+
+    statements = []
+    event.listen(
+        engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+    )
+    with patch("songtools.backlog.DB_LOOKUP_CHUNK_SIZE", 2):
+        dedup_song_folder(test_folder, engine)
+
+    assert len(statements) == 3
+    assert [song.exists() for song in songs] == [False, False, False, True, True]
+
+
+def test_content_hashes_are_filled_for_loaded_metadata(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    song = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+    with patch("songtools.backlog.config.backlog_path", test_folder):
+        load_backlog_folder_files(test_folder, engine)
+        load_backlog_folder_metadata(engine)
+        load_backlog_folder_metadata(engine, content_hash=True)
+
+    with Session(engine) as session:
+        stored = session.scalars(select(BacklogSong)).one()
+    assert stored.title == "Song uno"
+    assert stored.content_hash == audio_content_hash(song)
+
+
+def test_dedup_by_content_finds_the_same_audio_with_any_tags(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+
+    def song(path: str, audio: int, metadata: MetadataFields | None = None) -> Path:
+        data = create_test_mp3_data(metadata)
+        (test_folder / path).parent.mkdir(parents=True, exist_ok=True)
+        (test_folder / path).write_bytes(data[:-1] + bytes([audio]))
+        return test_folder / path
+
+    uno = MetadataFields("Uno", "JdP")
+    kept = song("incoming/tagged.mp3", 1, uno)
+    untagged_copy = song("incoming/untagged.mp3", 1)
+    other_mix = song("incoming/other mix.mp3", 2, uno)
+    in_collection = song("incoming/collection.mp3", 3)
+    song("collection/Collection.mp3", 3, MetadataFields("Tre", "JdP"))
+    in_backlog = song("incoming/backlog.mp3", 4)
+    song("loaded/Backlog.mp3", 4, MetadataFields("Quattro", "JdP"))
+    removed_from_backlog = song("incoming/removed.mp3", 5)
+
+    with patch("songtools.backlog.config.backlog_path", test_folder):
+        load_backlog_folder_files(test_folder / "loaded", engine)
+        load_backlog_folder_metadata(engine, content_hash=True)
+        with Session(engine) as session:
+            session.add(
+                BacklogSong(
+                    path="gone.mp3",
+                    content_hash=audio_content_hash(removed_from_backlog),
+                )
+            )
+            session.commit()
+        with patch(
+            "songtools.song_collection.config.collection_path",
+            test_folder / "collection",
+        ):
+            dedup_song_folder_by_content(test_folder / "incoming", engine)
+
+    assert kept.exists()
+    assert not untagged_copy.exists()
+    assert other_mix.exists()
+    assert not in_collection.exists()
+    assert not in_backlog.exists()
+    assert removed_from_backlog.exists()
+
+
 def test_duplicates_from_collection_are_handled(test_folder, caplog):
     engine = get_in_memory_engine()
     HeardSong.metadata.create_all(engine)
@@ -0,0 +1,40 @@
+import json
+import os
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from songtools.benchmarks.ingest import main as ingest_benchmark, STAGES
+from songtools.benchmarks.library import generate_library
+
+
+def _tree(root: Path) -> dict[str, bytes]:
+    return {
+        str(Path(dir_path, name).relative_to(root)): Path(dir_path, name).read_bytes()
+        for dir_path, _, names in os.walk(root)
+        for name in names
+    }
+
+
+def test_same_seed_generates_the_same_library(test_folder):
+    counts = generate_library(test_folder / "a", files=80, seed=7)
+    generate_library(test_folder / "b", files=80, seed=7, workers=2)
+    generate_library(test_folder / "c", files=80, seed=8)
+
+    assert sum(counts.values()) == 80
+    assert _tree(test_folder / "a") == _tree(test_folder / "b")
+    assert _tree(test_folder / "a").keys() != _tree(test_folder / "c").keys()
+
+
+def test_ingest_benchmark_stores_results(test_folder):
+    out = test_folder / "results.json"
+    result = CliRunner().invoke(
+        ingest_benchmark,
+        ["--songs", "10", "--collection-songs", "4", "--repeat", "1"]
+        + ["--out", str(out)],
+    )
+
+    assert result.exit_code == 0, result.output
+    results = json.loads(out.read_text())
+    assert list(results["stages"]) == STAGES
+    assert all(len(timings["runs"]) == 1 for timings in results["stages"].values())
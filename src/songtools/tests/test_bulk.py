@@ -0,0 +1,59 @@
+from unittest.mock import call, MagicMock, patch
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from songtools.db.bulk import bulk_insert_ignore, insert_ignore
+from songtools.db.models import BacklogSong
+from songtools.db.session import get_in_memory_engine
+
+
+def test_insert_ignore_falls_back_to_a_key_lookup_on_other_dialects():
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(BacklogSong(path="a.mp3", title="Kept"))
+        session.commit()
+
+        with patch.object(engine.dialect, "name", "mssql"):
+            insert_ignore(
+                session,
+                BacklogSong,
+                [
+                    {"path": "a.mp3", "title": "Replaced"},
+                    {"path": "b.mp3", "title": "New"},
+                    {"path": "b.mp3", "title": "Duplicate"},
+                ],
+            )
+        session.commit()
+
+        stored = session.execute(select(BacklogSong.path, BacklogSong.title)).all()
+    assert sorted(stored) == [("a.mp3", "Kept"), ("b.mp3", "New")]
+
+
+def test_copy_insert_ignore_merges_a_staging_table():
+    session = MagicMock()
+    session.get_bind.return_value.dialect.name = "postgresql"
+    connection = session.connection.return_value
+    driver_connection = connection.connection.driver_connection
+    cursor = driver_connection.cursor.return_value.__enter__.return_value
+    copy = cursor.copy.return_value.__enter__.return_value
+
+    bulk_insert_ignore(
+        session, BacklogSong, ["path", "title"], iter([("a.mp3", "A"), ("b.mp3", None)])
+    )
+
+    cursor.copy.assert_called_once_with(
+        "COPY song_backlog_staging (path, title) FROM STDIN"
+    )
+    assert copy.write_row.call_args_list == [
+        call(("a.mp3", "A")),
+        call(("b.mp3", None)),
+    ]
+    assert [c.args[0] for c in connection.exec_driver_sql.call_args_list] == [
+        "CREATE TEMP TABLE IF NOT EXISTS song_backlog_staging "
+        "(LIKE song_backlog INCLUDING DEFAULTS) ON COMMIT DROP",
+        "INSERT INTO song_backlog (path, title) "
+        "SELECT path, title FROM song_backlog_staging ON CONFLICT DO NOTHING",
+        "TRUNCATE song_backlog_staging",
+    ]
@@ -0,0 +1,94 @@
+import os
+import shutil
+from collections import Counter
+from pathlib import Path
+
+from songtools import config
+from songtools.backlog import clean_preimport_folder
+from songtools.benchmarks.library import generate_library
+from songtools.cleaning_plan import (
+    apply_cleaning_plan,
+    CleaningPlan,
+    DELETE,
+    plan_cleaning,
+    RENAME,
+)
+from songtools.tag_cache import TagCache
+
+
+def _tree(root: Path) -> set[str]:
+    return {
+        str(Path(dir_path, name).relative_to(root))
+        for dir_path, _, names in os.walk(root)
+        for name in names
+    }
+
+
+def test_applied_plan_matches_direct_cleaning(test_folder):
+    planned = test_folder / "planned"
+    generate_library(planned, files=150, seed=3)
+    direct = test_folder / "direct"
+    shutil.copytree(planned, direct)
+    before = _tree(planned)
+
+    plan = plan_cleaning([planned], workers=2)
+
+    assert _tree(planned) == before
+    assert {a.kind for a in plan.actions} == {RENAME, DELETE}
+    plan_path = test_folder / "plan.json"
+    plan.save(plan_path)
+    apply_cleaning_plan(CleaningPlan.load(plan_path))
+    clean_preimport_folder(direct)
+
+    # Direct cleaning overwrites a file when a song gets a name that is taken,
+    # the plan keeps the song under its old name instead
+    targets = Counter(a.target for a in plan.actions if a.kind == RENAME)
+    conflicting = {
+        str(Path(a.source).relative_to(planned))
+        for a in plan.actions
+        if a.kind == RENAME
+        and (
+            targets[a.target] > 1 or str(Path(a.target).relative_to(planned)) in before
+        )
+    }
+    assert _tree(direct) <= _tree(planned)
+    assert _tree(planned) - _tree(direct) <= conflicting
+
+
+def test_files_changed_since_planning_are_skipped(test_folder):
+    (test_folder / "notes.txt").write_text("old")
+    (test_folder / "cover.jpg").touch()
+
+    plan = plan_cleaning([test_folder])
+    (test_folder / "notes.txt").write_text("changed")
+    apply_cleaning_plan(plan)
+
+    assert (test_folder / "notes.txt").exists()
+    assert not (test_folder / "cover.jpg").exists()
+
+
+def test_planning_workers_share_the_tag_cache(test_folder, tmp_path, monkeypatch):
+    generate_library(test_folder, files=40, seed=5)
+    expected = plan_cleaning([test_folder]).actions
+    monkeypatch.setattr(config, "tag_cache_path", str(tmp_path / "tags.sqlite"))
+
+    plan = plan_cleaning([test_folder], workers=2)
+
+    assert sorted(plan.actions, key=lambda a: a.source) == sorted(
+        expected, key=lambda a: a.source
+    )
+    assert len(TagCache(tmp_path / "tags.sqlite")) > 0
+
+
+def test_plan_applies_from_another_working_directory(test_folder, monkeypatch):
+    (test_folder / "House").mkdir()
+    (test_folder / "House/cover.jpg").touch()
+    (test_folder / "House/Song - JdPouch.MP3").touch()
+    monkeypatch.chdir(test_folder)
+
+    plan = plan_cleaning([Path("House")])
+    monkeypatch.chdir("/")
+    apply_cleaning_plan(plan)
+
+    assert plan.roots == [str(test_folder / "House")]
+    assert _tree(test_folder / "House") == {"Song - Jdpouch.mp3"}
@@ -0,0 +1,52 @@
+import gzip
+import os
+from unittest.mock import patch
+
+from songtools.collection_snapshot import load_snapshot, scan_collection
+from songtools.conftest import make_simple_song_file
+from songtools.song_file_types import SongFile
+
+
+def test_unchanged_songs_are_taken_from_snapshot(test_folder):
+    snapshot_path = test_folder / "snapshot.jsonl.gz"
+    songs = [
+        make_simple_song_file(test_folder, "Song uno", "JdPouch"),
+        make_simple_song_file(test_folder, "Song (original mix)", "JdPouch"),
+    ]
+    scanned = scan_collection(songs, snapshot_path)
+
+    with patch("songtools.collection_snapshot.SongFile") as song_file:
+        reused = scan_collection(songs, snapshot_path)
+        song_file.assert_not_called()
+
+    assert reused == scanned
+    assert reused[1].built_name == "Jdpouch - Song"
+    assert reused[1].name_hash == SongFile(songs[1]).name_hash
+
+
+def test_changed_songs_are_parsed_again(test_folder):
+    snapshot_path = test_folder / "snapshot.jsonl.gz"
+    song = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+    scan_collection([song], snapshot_path)
+
+    make_simple_song_file(test_folder, "Song due", "JdPouch", filename=song.name)
+    stat = song.stat()
+    os.utime(song, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    records = scan_collection([song], snapshot_path)
+
+    assert records[0].title == "Song due"
+    assert load_snapshot(snapshot_path)[str(song.absolute())].title == "Song due"
+
+
+def test_snapshot_of_other_version_is_ignored(test_folder):
+    snapshot_path = test_folder / "snapshot.jsonl.gz"
+    song = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+    scan_collection([song], snapshot_path)
+
+    with gzip.open(snapshot_path, "rt") as f:
+        rows = f.readlines()[1:]
+    with gzip.open(snapshot_path, "wt") as f:
+        f.write('{"format": "songtools-collection-snapshot", "version": 0}\n')
+        f.writelines(rows)
+
+    assert load_snapshot(snapshot_path) == {}
@@ -0,0 +1,66 @@
+import io
+from pathlib import Path
+
+from mutagen import flac
+
+from songtools.conftest import (
+    create_test_m4a_data,
+    create_test_mp3_data,
+    MetadataFields,
+)
+from songtools.content_hash import audio_content_hash
+
+FLAC_PATH = Path(__file__).parent / "fixtures/silence20s.flac"
+
+
+def _write(path: Path, data: bytes) -> Path:
+    path.write_bytes(data)
+    return path
+
+
+def _tagged_flac(title: str) -> bytes:
+    data = io.BytesIO(FLAC_PATH.read_bytes())
+    audio = flac.FLAC(data)
+    audio["title"] = title
+    data.seek(0)
+    audio.save(data)
+    return data.getvalue()
+
+
+def test_differently_tagged_copies_have_the_same_hash(test_folder):
+    untagged = _write(test_folder / "a.mp3", create_test_mp3_data())
+    tagged = _write(
+        test_folder / "b.mp3", create_test_mp3_data(MetadataFields("Uno", "JdP"))
+    )
+    id3v1 = _write(
+        test_folder / "c.mp3", create_test_mp3_data() + b"TAG" + b"\x00" * 125
+    )
+    assert audio_content_hash(untagged) is not None
+    assert audio_content_hash(untagged) == audio_content_hash(tagged)
+    assert audio_content_hash(untagged) == audio_content_hash(id3v1)
+
+    flac_hash = audio_content_hash(_write(test_folder / "a.flac", _tagged_flac("A")))
+    assert flac_hash == audio_content_hash(FLAC_PATH)
+    assert flac_hash == audio_content_hash(
+        _write(test_folder / "b.flac", _tagged_flac("A much longer title"))
+    )
+
+    m4a = _write(test_folder / "a.m4a", create_test_m4a_data())
+    tagged_m4a = _write(
+        test_folder / "b.m4a", create_test_m4a_data(MetadataFields("Uno", "JdP"))
+    )
+    assert audio_content_hash(m4a) == audio_content_hash(tagged_m4a)
+
+
+def test_different_audio_has_a_different_hash(test_folder):
+    data = create_test_mp3_data(MetadataFields("Uno", "JdP"))
+    song = _write(test_folder / "a.mp3", data)
+    other_mix = _write(test_folder / "b.mp3", data[:-1] + b"\x01")
+
+    assert audio_content_hash(song) != audio_content_hash(other_mix)
+
+
+def test_files_without_audio_payload_are_not_hashed(test_folder):
+    assert audio_content_hash(_write(test_folder / "empty.mp3", b"")) is None
+    assert audio_content_hash(_write(test_folder / "a.flac", b"ID3")) is None
+    assert audio_content_hash(_write(test_folder / "a.txt", b"text")) is None
@@ -0,0 +1,107 @@
+import io
+import struct
+from pathlib import Path
+from unittest.mock import patch
+
+import mutagen.id3 as mt_id3
+import pytest
+from mutagen import flac
+from mutagen.mp4 import MP4
+
+from songtools.conftest import create_test_m4a_data, MetadataFields
+from songtools.fast_tags import _parse_ilst, FastTags, read_id3
+from songtools.song_file_types import (
+    FlacFile,
+    ID3File,
+    M4AFile,
+    StaticMetaRetriever,
+)
+
+
+def _read_with_both_backends(retriever_class, path: Path) -> list[dict]:
+    values = []
+    for backend in ["mutagen", "fast"]:
+        with patch("songtools.song_file_types.config.tag_reader", backend):
+            retriever = retriever_class(path)
+        assert isinstance(retriever.metadata, FastTags) == (backend == "fast")
+        values.append(StaticMetaRetriever.from_retriever(retriever).values)
+    return values
+
+
+@pytest.mark.parametrize("id3_version", [3, 4])
+def test_fast_id3_reader_matches_mutagen(test_folder, test_mp3_data, id3_version):
+    mp3_file = test_folder / "song.mp3"
+    mp3_file.write_bytes(test_mp3_data)
+    tags = mt_id3.ID3()
+    tags.add(mt_id3.TPE1(encoding=1, text="Chi:mera, Jake DaPhunk"))
+    tags.add(mt_id3.TIT2(encoding=3, text="Žluťoučký kůň"))
+    tags.add(mt_id3.TBPM(encoding=0, text="124"))
+    tags.add(mt_id3.TCON(encoding=3, text="(17)"))
+    tags.add(mt_id3.TDRC(encoding=0, text="2019-04-01"))
+    tags.add(mt_id3.COMM(encoding=3, lang="eng", desc="", text="8A - Energy 7"))
+    tags.add(mt_id3.APIC(encoding=0, mime="image/png", data=b"\x00" * 50000))
+    tags.save(mp3_file, v2_version=id3_version)
+
+    mutagen_values, fast_values = _read_with_both_backends(ID3File, mp3_file)
+    assert fast_values == mutagen_values
+    assert fast_values["year"] == 2019
+    assert fast_values["genre"] == "Rock"
+    assert fast_values["energy"] == 7
+
+
+def test_fast_flac_reader_matches_mutagen(test_folder, flac_data):
+    flac_file = test_folder / "song.flac"
+    flac_file.write_bytes(flac_data)
+    audio = flac.FLAC(flac_file)
+    audio["ARTIST"] = ["JdPouch", "Chimera"]
+    audio["title"] = "Song uno"
+    audio["bpm"] = "120"
+    audio["date"] = "2020-01-01"
+    audio["genre"] = "House"
+    audio["initialkey"] = "7A"
+    audio.save()
+
+    mutagen_values, fast_values = _read_with_both_backends(FlacFile, flac_file)
+    assert fast_values == mutagen_values
+    assert fast_values["artists"] == "JdPouch, Chimera"
+
+
+def test_fast_mp4_reader_matches_mutagen(test_folder):
+    m4a_file = test_folder / "song.m4a"
+    m4a_file.write_bytes(create_test_m4a_data(MetadataFields("Song uno", "JdPouch")))
+    audio = MP4(m4a_file)
+    audio["tmpo"] = [128]
+    audio["\xa9day"] = "2021"
+    audio["\xa9gen"] = "Techno"
+    audio["\xa9cmt"] = "5A - Energy 6"
+    audio.save()
+
+    mutagen_values, fast_values = _read_with_both_backends(M4AFile, m4a_file)
+    assert fast_values == mutagen_values
+    assert fast_values["duration_seconds"] == 20
+
+
+def test_fast_reader_gives_up_on_files_it_cant_parse(test_folder, test_mp3_data):
+    untagged = test_folder / "untagged.mp3"
+    untagged.write_bytes(test_mp3_data)
+    id3v1 = test_folder / "id3v1.mp3"
+    id3v1.write_bytes(test_mp3_data)
+    tags = mt_id3.ID3()
+    tags.add(mt_id3.TIT2(encoding=3, text="Song uno"))
+    tags.save(id3v1)
+    assert read_id3(id3v1) is not None
+    with open(id3v1, "ab") as f:
+        f.write(b"TAG" + b"\x00" * 125)
+
+    assert read_id3(untagged) is None
+    assert read_id3(id3v1) is None
+
+
+@pytest.mark.parametrize("genre_id, genre", [(0, None), (18, "Rock"), (255, None)])
+def test_unknown_mp4_genre_ids_are_skipped(genre_id, genre):
+    data = struct.pack(">I4sI4xH", 18, b"data", 0, genre_id)
+    ilst = struct.pack(">I4s", 8 + len(data), b"gnre") + data
+
+    tags = _parse_ilst(io.BytesIO(ilst), len(ilst))
+
+    assert tags.get("\xa9gen") == ([genre] if genre else None)
@@ -0,0 +1,79 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import click
+import pytest
+
+from songtools import config, utils
+from songtools.conftest import make_simple_song_file
+from songtools.folder_jobs import (
+    _run_job,
+    clean_folder_job,
+    echo_job_summary,
+    run_folder_jobs,
+)
+from songtools.metrics import counters
+from songtools.tag_cache import TagCache
+
+
+def test_folders_are_processed_in_workers(test_folder):
+    folders = []
+    for name in ["House", "Techno"]:
+        folder = test_folder / name
+        folder.mkdir()
+        (folder / "cover.jpg").touch()
+        (folder / "Song.MP3").touch()
+        folders.append(folder)
+    deletes = counters()["deletes"]
+
+    results = run_folder_jobs(clean_folder_job, folders, jobs=2)
+
+    assert sorted(r.folder for r in results) == folders
+    assert all(r.error is None for r in results)
+    assert not (test_folder / "House/cover.jpg").exists()
+    assert (test_folder / "Techno/Song.mp3").exists()
+    assert counters()["deletes"] == deletes + 2
+
+
+def test_workers_share_the_tag_cache(test_folder, tmp_path, monkeypatch):
+    folders = []
+    for name in ["House", "Techno"]:
+        folder = test_folder / name
+        folder.mkdir()
+        for i in range(4):
+            make_simple_song_file(folder, f"Song {i}", "JdPouch")
+        folders.append(folder)
+    monkeypatch.setattr(config, "tag_cache_path", str(tmp_path / "tags.sqlite"))
+
+    results = run_folder_jobs(clean_folder_job, folders, jobs=2)
+
+    assert [r.error for r in results] == [None, None]
+    assert sum(r.seconds for r in results) < 10
+    assert len(TagCache(tmp_path / "tags.sqlite")) == 8
+
+
+def test_failed_folders_are_summarized(test_folder):
+    (test_folder / "empty").mkdir()
+    (test_folder / "full").mkdir()
+    (test_folder / "full/song.mp3").touch()
+
+    results = run_folder_jobs(
+        Path.rmdir, [test_folder / "empty", test_folder / "full"], jobs=2
+    )
+
+    failed = [r for r in results if r.error]
+    assert [r.folder.name for r in failed] == ["full"]
+    assert failed[0].error.startswith("OSError")
+    with pytest.raises(click.ClickException, match="1 folders failed"):
+        echo_job_summary(results)
+
+
+def test_job_log_records_are_written_when_the_job_ends(test_folder):
+    with (
+        patch.object(config, "log_store", True),
+        patch.object(config, "log_dir", str(test_folder)),
+    ):
+        _run_job(Path.rmdir, test_folder / "missing")
+
+    log = (test_folder / utils.FILE_NAME).read_text()
+    assert log.startswith("[ERR] Job failed on")
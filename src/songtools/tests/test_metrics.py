@@ -0,0 +1,36 @@
+import json
+
+from songtools.backlog import load_backlog_folder_files, remove_irrelevant_file
+from songtools.db.models import BacklogSong
+from songtools.db.session import get_in_memory_engine
+from songtools.metrics import MetricsReport
+
+
+def test_run_metrics_are_stored_as_json(test_folder):
+    engine = get_in_memory_engine()
+    BacklogSong.metadata.create_all(engine)
+    for i in range(3):
+        (test_folder / f"song_{i}.mp3").touch()
+    (test_folder / "cover.jpg").touch()
+    out_path = test_folder / "metrics.json"
+
+    with MetricsReport(out_path):
+        remove_irrelevant_file(test_folder / "cover.jpg")
+        load_backlog_folder_files(test_folder, engine)
+
+    report = json.loads(out_path.read_text())
+    assert report["counters"]["deletes"] == 1
+    assert report["counters"]["files_walked"] == 3
+    assert report["counters"]["db_statements"] >= 2
+    assert report["counters"]["db_rows_written"] == 3
+    assert report["stages"]["load_backlog_folder_files"]["calls"] == 1
+
+
+def test_run_metrics_are_stored_as_prometheus_textfile(test_folder):
+    out_path = test_folder / "songtools.prom"
+    with MetricsReport(out_path):
+        pass
+
+    lines = out_path.read_text().splitlines()
+    assert "# TYPE songtools_run_files_walked gauge" in lines
+    assert 'songtools_run_files_walked{command=""} 0' in lines
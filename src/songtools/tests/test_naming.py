@@ -9,6 +9,8 @@ from songtools.naming import (
     capitalize,
     extract_featuring_artists,
     build_correct_song_file_name,
+    build_song_names,
+    song_name_hash,
 )
 
 
@@ -106,3 +108,28 @@ def test_featuring_extraction(test_in, test_out):
 )
 def test_build_correct_song_file_name(test_artists, test_title, test_out):
     assert build_correct_song_file_name(test_artists, test_title) == test_out
+
+
+def test_repeated_names_are_styled_once():
+    build_correct_song_file_name(["Jake_holm", "JDP"], "Song uno")
+    misses = basic_music_file_style.cache_info().misses
+    name = build_correct_song_file_name(["JDP", "Jake_holm"], "Song uno")
+
+    assert basic_music_file_style.cache_info().misses == misses
+    assert name == "Jake Holm, Jdp - Song Uno"
+
+
+def test_song_names_are_built_in_batch():
+    songs = [
+        (["JDP"], "Song uno"),
+        (("Tero", "JDP"), "Song due"),
+        (["JDP"], "Song uno"),
+    ]
+    built = build_song_names(songs)
+
+    assert built[0] == built[2]
+    assert built[1] == (
+        "Jdp, Tero - Song Due",
+        song_name_hash(build_correct_song_file_name(["Tero", "JDP"], "Song due")),
+    )
+    assert build_song_names(songs * 3, workers=2, chunk_size=1) == built * 3
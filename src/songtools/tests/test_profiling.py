@@ -0,0 +1,41 @@
+from unittest.mock import patch
+
+from songtools.backlog import apply_file_rules, lower_file_suffix
+from songtools.naming import build_correct_song_file_name
+from songtools.profiling import collect_stages, Profiler, stage, stage_timings
+
+
+def test_stages_are_timed_only_while_profiling(test_folder):
+    with stage("outside"):
+        pass
+
+    with Profiler(test_folder / "run.prof"):
+        with stage("outer"):
+            build_correct_song_file_name(["JdPouch"], "Song uno")
+            build_correct_song_file_name(["JdPouch"], "Song due")
+
+    timings = stage_timings()
+    assert "outside" not in timings
+    assert timings["outer"].calls == 1
+    assert timings["naming"].calls == 2
+    assert timings["outer"].seconds >= timings["naming"].seconds
+    assert (test_folder / "run.prof").exists()
+
+
+def test_file_rules_are_timed_only_while_collecting(test_folder):
+    for i in range(3):
+        (test_folder / f"song_{i}.MP3").touch()
+
+    with patch("songtools.backlog.stage", wraps=stage) as backlog_stage:
+        apply_file_rules(test_folder, [lower_file_suffix])
+    assert all(c.args != ("lower_file_suffix",) for c in backlog_stage.mock_calls)
+
+    with collect_stages():
+        apply_file_rules(test_folder, [lower_file_suffix])
+    assert stage_timings()["lower_file_suffix"].calls == 3
+
+
+def test_naming_enters_no_stage_while_not_collecting():
+    with patch("songtools.naming.stage", wraps=stage) as naming_stage:
+        build_correct_song_file_name(["JdPouch"], "Song uno")
+    naming_stage.assert_not_called()
@@ -0,0 +1,38 @@
+import os
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import create_engine, text
+from songtools.db import session
+
+
+def test_engine_is_created_once_and_pool_usage_is_tracked():
+    sqlite_engine = create_engine("sqlite:///:memory:")
+    with patch.object(
+        session, "create_engine", return_value=sqlite_engine
+    ) as engine_factory:
+        engine = session.get_engine()
+        assert session.get_engine() is engine
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        session.dispose_engine()
+
+    assert engine_factory.call_count == 1
+    _, kwargs = engine_factory.call_args
+    assert kwargs["pool_size"] == 5
+    assert kwargs["pool_pre_ping"] is True
+    usage = session.pool_usage()
+    assert usage.connects >= 1
+    assert usage.checked_out == 0
+    assert usage.max_checked_out >= 1
+
+
+def test_worker_detaches_the_engine_of_the_parent():
+    parent_engine = MagicMock()
+    with (
+        patch.object(session, "_engine", parent_engine),
+        patch.object(session, "_engine_pid", os.getpid() + 1),
+    ):
+        session.dispose_engine()
+        assert session._engine is None
+
+    parent_engine.dispose.assert_called_once_with(close=False)
@@ -1,4 +1,6 @@
 from unittest.mock import patch
+
+from songtools.content_hash import audio_content_hash
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 
@@ -6,10 +8,15 @@ from songtools.conftest import make_simple_song_file
 from songtools.db.models import CollectionSong, HeardSong
 from songtools.db.session import get_in_memory_engine
 from songtools.song_collection import (
+    CollectionChanges,
+    get_collection_content_hashes,
+    refresh_collection_records,
     get_incorrectly_formatted_collection_names,
     sync_collection_items,
+    sync_collection_with_heard_songs,
 )
 from songtools.song_file_types import SongFile
+from songtools.tag_cache import TagCache
 
 
 def test_get_list_of_incorrectly_formatted_songs_in_collection(test_folder):
@@ -96,3 +103,98 @@ def test_syncing_collection_makes_db_consistent_with_folder(test_folder):
         assert 5 == len(heard_songs)
         heard_songs = session.scalars(select(HeardSong)).all()
         assert 6 == len(heard_songs)
+
+
+def test_refreshing_collection_only_changes_what_differs(test_folder):
+    songs = {
+        name: SongFile(make_simple_song_file(test_folder, name, "artist"))
+        for name in ["kept", "grown", "new"]
+    }
+    db_engine = get_in_memory_engine()
+    CollectionSong.metadata.create_all(db_engine)
+    with Session(db_engine) as session:
+        session.add_all(
+            [
+                CollectionSong(
+                    name_hash=songs["kept"].name_hash,
+                    file_path=songs["kept"].path.name,
+                    file_size=songs["kept"].file_size_kb,
+                ),
+                CollectionSong(
+                    name_hash=songs["grown"].name_hash,
+                    file_path=songs["grown"].path.name,
+                    file_size=1,
+                ),
+                CollectionSong(name_hash="gone", file_path="gone.mp3", file_size=1),
+            ]
+        )
+        session.commit()
+
+    changes = refresh_collection_records(
+        {song.name_hash: song for song in songs.values()}, db_engine
+    )
+
+    assert changes == CollectionChanges(inserted=1, updated=1, deleted=1)
+    with Session(db_engine) as session:
+        sizes = dict(
+            session.execute(
+                select(CollectionSong.file_path, CollectionSong.file_size)
+            ).all()
+        )
+    assert sizes == {song.path.name: song.file_size_kb for song in songs.values()}
+
+
+def test_collection_content_is_hashed_once(test_folder):
+    collection_folder = test_folder / "collection"
+    collection_folder.mkdir()
+    for i in range(3):
+        make_simple_song_file(collection_folder, f"Song {i}")
+    cache = TagCache(test_folder / "tags.sqlite")
+
+    with (
+        patch("songtools.song_collection.config.collection_path", collection_folder),
+        patch("songtools.content_hash.get_tag_cache", return_value=cache),
+        patch(
+            "songtools.content_hash.audio_content_hash", wraps=audio_content_hash
+        ) as hash_file,
+    ):
+        first = get_collection_content_hashes()
+        second = get_collection_content_hashes()
+
+    assert hash_file.call_count == 3
+    assert first == second
+    # Songs with the same audio share one hash
+    assert len(first) == 1
+
+
+def test_heard_songs_are_reconciled_with_collection_records():
+    engine = get_in_memory_engine()
+    HeardSong.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            [
+                HeardSong(name_hash="removed", in_collection=True),
+                HeardSong(name_hash="unknown", in_collection=None),
+                HeardSong(name_hash="added", in_collection=False),
+                HeardSong(name_hash="never", in_collection=False),
+                CollectionSong(name_hash="unknown", file_path="u.mp3", file_size=1),
+                CollectionSong(name_hash="added", file_path="a.mp3", file_size=1),
+                CollectionSong(name_hash="new", file_path="n.mp3", file_size=1),
+            ]
+        )
+        session.commit()
+
+    sync_collection_with_heard_songs(engine)
+
+    with Session(engine) as session:
+        heard = {
+            song.name_hash: (song.in_collection, song.file_name)
+            for song in session.scalars(select(HeardSong))
+        }
+    assert heard == {
+        "removed": (False, None),
+        "unknown": (True, None),
+        "added": (True, None),
+        "never": (False, None),
+        "new": (True, "n.mp3"),
+    }
@@ -1,9 +1,11 @@
 from mutagen import flac
 import pytest
 from pathlib import Path
+from unittest.mock import patch
 from songtools.conftest import create_test_mp3_data, MetadataFields
 from songtools.song_file_types import (
     SongFile,
+    StaticMetaRetriever,
     UnsupportedSongType,
     UnableToExtractData,
 )
@@ -93,3 +95,24 @@ def test_flac_file_gets_metadata(test_folder: Path, flac_data):
     assert song.artists == ["JdPouch"]
     assert song.bpm == 120.0
     assert song.key == "7A"
+
+
+def test_fields_are_resolved_once_and_mutagen_object_is_dropped(
+    test_folder: Path,
+):
+    test_file = test_folder / "JdPouch - Song.mp3"
+    mt = MetadataFields(artist="JdPouch, Hugo", title="Song")
+    test_file.write_bytes(create_test_mp3_data(mt))
+    song = SongFile(test_file)
+    name_hash = song.name_hash
+
+    assert type(song.metadata) is StaticMetaRetriever
+    assert not hasattr(song, "__dict__")
+    with patch(
+        "songtools.song_file_types.build_correct_song_file_name",
+        side_effect=AssertionError,
+    ):
+        test_file.unlink()
+        assert song.name_hash == name_hash
+        assert song.file_size_kb > 0
+        assert song.artists is song.artists
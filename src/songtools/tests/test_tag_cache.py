@@ -0,0 +1,117 @@
+import os
+import sqlite3
+from unittest.mock import patch
+
+from songtools.conftest import make_simple_song_file
+from songtools.song_file_types import SongFile
+from songtools.tag_cache import TagCache
+
+
+def test_unchanged_file_is_served_from_cache(test_folder):
+    cache = TagCache(test_folder / "tags.sqlite")
+    song_path = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+
+    with patch("songtools.song_file_types.get_tag_cache", return_value=cache):
+        parsed = SongFile(song_path)
+        with patch("songtools.song_file_types.mutagen.File") as mutagen_file:
+            cached = SongFile(song_path)
+            mutagen_file.assert_not_called()
+
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0}
+    assert cached.artists == parsed.artists
+    assert cached.title == parsed.title
+    assert cached.duration_seconds == parsed.duration_seconds
+    assert cached.name_hash == parsed.name_hash
+
+
+def test_changed_file_is_parsed_again(test_folder):
+    cache = TagCache(test_folder / "tags.sqlite")
+    song_path = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+
+    with patch("songtools.song_file_types.get_tag_cache", return_value=cache):
+        SongFile(song_path)
+        make_simple_song_file(
+            test_folder, "Song due", "JdPouch", filename=song_path.name
+        )
+        stat = song_path.stat()
+        os.utime(song_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        song = SongFile(song_path)
+
+    assert cache.misses == 2
+    assert song.title == "Song due"
+
+
+def test_least_recently_used_entries_are_evicted(test_folder):
+    cache = TagCache(test_folder / "tags.sqlite", max_entries=10)
+    stat = test_folder.stat()
+    for i in range(12):
+        cache.put(test_folder / f"song_{i}.mp3", stat, {}, None)
+    cache.get(test_folder / "song_0.mp3", stat)
+
+    assert cache.evict() == 3
+    assert len(cache) == 9
+    assert cache.get(test_folder / "song_0.mp3", stat) is not None
+    assert cache.get(test_folder / "song_1.mp3", stat) is None
+
+
+def test_cache_hits_are_touched_in_one_batch(test_folder):
+    cache = TagCache(test_folder / "tags.sqlite")
+    stat = test_folder.stat()
+    for i in range(3):
+        cache.put(test_folder / f"song_{i}.mp3", stat, {}, None)
+    cache.commit()
+    statements = []
+    cache.connection.set_trace_callback(statements.append)
+
+    for i in range(3):
+        assert cache.get(test_folder / f"song_{i}.mp3", stat) is not None
+    assert not [s for s in statements if s.startswith("UPDATE")]
+
+    cache.commit()
+    assert len([s for s in statements if s.startswith("UPDATE")]) == 3
+
+
+def test_content_hash_is_cached_with_the_tags(test_folder):
+    cache = TagCache(test_folder / "tags.sqlite")
+    song_path = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+
+    with (
+        patch("songtools.song_file_types.get_tag_cache", return_value=cache),
+        patch("songtools.content_hash.get_tag_cache", return_value=cache),
+    ):
+        content_hash = SongFile(song_path).content_hash
+        with patch("songtools.content_hash.audio_content_hash") as hash_file:
+            assert SongFile(song_path).content_hash == content_hash
+            hash_file.assert_not_called()
+
+    assert cache.get(song_path, song_path.stat()).content_hash == content_hash
+
+
+def test_content_hash_is_cached_without_tags(test_folder):
+    cache = TagCache(test_folder / "tags.sqlite")
+    song_path = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+    stat = song_path.stat()
+
+    cache.put_content_hash(song_path, stat, "abc")
+    assert cache.get(song_path, stat) is None
+    cache.put(song_path, stat, {"title": "Song uno"}, None)
+    assert cache.get(song_path, stat).content_hash == "abc"
+
+    os.utime(song_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    cache.put(song_path, song_path.stat(), {"title": "Song due"}, None)
+    assert cache.get_content_hash(song_path, song_path.stat()) is None
+
+
+def test_locked_cache_is_a_miss(test_folder):
+    cache = TagCache(test_folder / "tags.sqlite")
+    song_path = make_simple_song_file(test_folder, "Song uno", "JdPouch")
+    locked = sqlite3.OperationalError("database is locked")
+
+    with (
+        patch("songtools.song_file_types.get_tag_cache", return_value=cache),
+        patch.object(cache, "get", side_effect=locked),
+        patch.object(cache, "put", side_effect=locked),
+    ):
+        song = SongFile(song_path)
+
+    assert song.title == "Song uno"
@@ -0,0 +1,27 @@
+import json
+from unittest.mock import patch
+
+from songtools import config
+from songtools.utils import echo, LogSink
+
+
+def test_log_sink_writes_queued_records_as_json_lines(test_folder):
+    log_path = test_folder / "songtools.log"
+    sink = LogSink(log_path, json_lines=True)
+    for i in range(100):
+        sink.write(f"Can't rename file {i}", "ERR")
+    sink.close()
+
+    records = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert len(records) == 100
+    assert records[-1]["type"] == "ERR"
+    assert records[-1]["msg"] == "Can't rename file 99"
+
+
+def test_quiet_mode_prints_only_checks_and_errors(capsys):
+    with patch.object(config, "log_quiet", True):
+        echo("Renamed song", "OK")
+        echo("Skipping meta file", "INFO")
+        echo("Missing in the db", "CHECK")
+
+    assert capsys.readouterr().out == "Missing in the db\n"
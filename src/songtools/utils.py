@@ -1,6 +1,14 @@
+import atexit
+import json
+import os
+import queue
+import threading
+
 import click
 from pathlib import Path
 from datetime import datetime
+from itertools import islice
+from typing import Iterable, Iterator
 from songtools import config as config
 
 
@@ -15,12 +23,90 @@ COLOR_CFG = {
 }
 
 
+QUIET_TYPES = ["INFO", "OK"]
+
+
+class LogSink:
+    """Log file kept open for the whole run.
+    Records are queued and written by a background thread, which flushes the
+    file whenever the queue runs empty, so a burst of messages doesn't cost a
+    write per message.
+    """
+
+    def __init__(self, path: Path, json_lines: bool = False) -> None:
+        self.json_lines = json_lines
+        self.file = open(path, "a", encoding="utf-8")
+        self.records: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self._write_records, name="songtools-log", daemon=True
+        )
+        self.thread.start()
+
+    def write(self, msg: str, msg_type: str) -> None:
+        self.records.put((datetime.now(), msg_type, msg))
+
+    def close(self) -> None:
+        """Write all queued records and close the file."""
+        if self.thread.is_alive():
+            self.records.put(None)
+            self.thread.join()
+        self.file.close()
+
+    def _write_records(self) -> None:
+        while (record := self.records.get()) is not None:
+            self.file.write(self._format(*record))
+            if self.records.empty():
+                self.file.flush()
+        self.file.flush()
+
+    def _format(self, time: datetime, msg_type: str, msg: str) -> str:
+        if self.json_lines:
+            record = {"time": time.isoformat(), "type": msg_type, "msg": msg}
+            return json.dumps(record, ensure_ascii=False) + "\n"
+        return f"[{msg_type}] {msg}\n"
+
+
+_log_sink: LogSink | None = None
+_log_sink_pid: int | None = None
+
+
+def get_log_sink() -> LogSink:
+    """Return the log sink of the process, it is closed at exit."""
+    global _log_sink, _log_sink_pid
+    if _log_sink is None or _log_sink_pid != os.getpid():
+        _log_sink = LogSink(
+            Path(config.log_dir) / FILE_NAME, json_lines=config.log_format == "json"
+        )
+        _log_sink_pid = os.getpid()
+        atexit.register(_log_sink.close)
+    return _log_sink
+
+
+def close_log_sink() -> None:
+    """Write all queued records of the process now, the next record opens the
+    file again. Worker processes of a pool don't run atexit handlers, they
+    have to call it after each job.
+    """
+    global _log_sink, _log_sink_pid
+    if _log_sink is not None and _log_sink_pid == os.getpid():
+        _log_sink.close()
+    _log_sink = None
+    _log_sink_pid = None
+
+
 def echo(msg: str, msg_type: str = "INFO") -> None:
     if msg_type not in COLOR_CFG:
         raise ValueError(f"Unknown message type {msg_type}")
 
-    click.secho(msg, fg=COLOR_CFG[msg_type]["fg"], bg=COLOR_CFG[msg_type]["bg"])
+    if not (config.log_quiet and msg_type in QUIET_TYPES):
+        click.secho(msg, fg=COLOR_CFG[msg_type]["fg"], bg=COLOR_CFG[msg_type]["bg"])
 
     if config.log_store and msg_type in config.log_store_type:
-        with open(Path(config.log_dir) / FILE_NAME, "a+") as f:
-            f.writelines([f"[{msg_type}] {msg}\n"])
+        get_log_sink().write(msg, msg_type)
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Split items into lists of at most `size` items."""
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk